@@ -0,0 +1,291 @@
+#!/usr/bin/python
+
+# Script name: DamageMasker_benchmark.py
+# Author: Lesley Sitter
+# Github: https://github.com/IamIamI/DamageMasker
+
+# Description: Benchmark and regression check for DamageMasker.py.
+# Generates a deterministic synthetic reference (FASTA) and ancient DNA BAM file (coordinate sorted and indexed), with a configurable
+# number of reads, read length distribution, indel and soft clip rates, strand mix and simulated deamination at the molecule ends.
+# Every masking mode (-m H/E/S/F) is then run for both library types (-s S/D), with and without reference guidance, and the
+# reads/sec, wall time, peak memory (RSS) and a checksum of the output reads are reported as JSON.
+# When a baseline script is given (e.g. an older DamageMasker.py), the same runs are done with it and the outputs are compared,
+# so an optimized version can show it produces the same output while being faster. The reads (name, flag, position, CIGAR and
+# sequence) and their base qualities are compared separately, as DamageMasker up to v1.1 clears the base qualities of every read
+# it writes, and the edit distance stats are compared column by column, as later versions count indels differently.
+# DamageMasker up to v1.1 can't mask reads with soft clips or indels against a reference (their sequence no longer matches
+# their CIGAR), so use --baseline_compatible (no soft clips or indels) to compare the reference guided runs against it.
+
+# Example: python Benchmark/DamageMasker_benchmark.py --reads 200000 --output bench.json
+# Example: python Benchmark/DamageMasker_benchmark.py --baseline Previous_version/DamageMasker_v1.0.py --extra_args "--threads 4"
+# Example: python Benchmark/DamageMasker_benchmark.py --baseline DamageMasker_v1.1.py --baseline_compatible
+#   (v1.1 is not kept in Previous_version, write it out of the git history first, from the commit that has DamageMasker.py at v1.1:
+#   git show <commit>:DamageMasker.py > DamageMasker_v1.1.py, 'git log --reverse --oneline -- DamageMasker.py' lists the candidates)
+
+import os
+import sys
+import json
+import time
+import shlex
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+try:
+	import numpy as np
+	import pysam
+except ImportError:
+	print("\nError: The benchmark requires pysam and numpy to be installed.\nTry \'pip install pysam numpy\' or \'pip3 install pysam numpy\' (depending on your setup) to install them.\n\n")
+	sys.exit(1)
+
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+# Write a random reference genome with the given number of contigs, and index it
+def generate_reference(fasta_file, contigs, contig_length, rng) :
+	reference = {}
+	with open(fasta_file, "w") as o:
+		for i in range(contigs) :
+			contig = f"chr{i+1}"
+			reference[contig] = np.array(list(b'ACGT'), dtype=np.uint8)[rng.integers(0, 4, contig_length)].tobytes().decode()
+			print(f">{contig}", file=o)
+			for start in range(0, contig_length, 60) :
+				print(reference[contig][start:start+60], file=o)
+	pysam.faidx(fasta_file)
+	return reference
+
+# Simulate deamination on a molecule (in the orientation of the original molecule). C>T happens with probability
+# deamination at the first base, decaying by half with every base further in. Double stranded libraries also show
+# G>A at the 3' end, single stranded libraries show C>T at the 3' end as well
+def deaminate(molecule, deamination, strandness, rng) :
+	molecule = list(molecule)
+	length = len(molecule)
+	damage = deamination * 0.5 ** np.arange(length)
+	hits_5 = rng.random(length) < damage
+	hits_3 = rng.random(length) < damage
+	for pos in np.flatnonzero(hits_5).tolist() :
+		if molecule[pos] == 'C' :
+			molecule[pos] = 'T'
+	for pos in np.flatnonzero(hits_3).tolist() :
+		pos = length - 1 - pos
+		if strandness == "D" and molecule[pos] == 'G' :
+			molecule[pos] = 'A'
+		elif strandness == "S" and molecule[pos] == 'C' :
+			molecule[pos] = 'T'
+	return ''.join(molecule)
+
+# Simulate a single mapped read, returns the read sequence and cigar tuples
+def simulate_read(reference_seq, start, length, args, rng) :
+	cigar = []
+	clip_5 = int(rng.integers(1, 8)) if rng.random() < args.clip_rate else 0
+	clip_3 = int(rng.integers(1, 8)) if rng.random() < args.clip_rate else 0
+	aligned = max(10, length - clip_5 - clip_3)
+	first = aligned // 2
+	indel = rng.random() < args.indel_rate
+	indel_length = int(rng.integers(1, 4))
+	insertion = indel and rng.random() < 0.5
+	second = aligned - first - (indel_length if insertion else 0)
+	sequence = reference_seq[start:start+first]
+	ref_pos = start + first
+	if clip_5 :
+		cigar.append((4, clip_5))
+		sequence = ''.join(rng.choice(list('ACGT'), clip_5)) + sequence
+	cigar.append((0, first))
+	if indel and insertion :
+		cigar.append((1, indel_length))
+		sequence += ''.join(rng.choice(list('ACGT'), indel_length))
+	elif indel :
+		cigar.append((2, indel_length))
+		ref_pos += indel_length
+	cigar.append((0, second))
+	sequence += reference_seq[ref_pos:ref_pos+second]
+	if clip_3 :
+		cigar.append((4, clip_3))
+		sequence += ''.join(rng.choice(list('ACGT'), clip_3))
+	return sequence, cigar
+
+# Write a coordinate sorted and indexed BAM file with simulated ancient DNA reads
+def generate_bam(bam_file, reference, args, rng) :
+	contigs = list(reference)
+	header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': contig, 'LN': len(reference[contig])} for contig in contigs],
+		'RG': [{'ID': 'bench', 'LB': 'bench', 'SM': 'bench'}]}
+	reads_per_contig = np.bincount(rng.integers(0, len(contigs), args.reads), minlength=len(contigs))
+	mismatch_bases = np.array(list('ACGT'))
+	with pysam.AlignmentFile(bam_file, 'wb', header=header) as out_file :
+		read_number = 0
+		for contig_id, contig in enumerate(contigs) :
+			reference_seq = reference[contig]
+			lengths = np.clip(np.rint(rng.normal(args.length_mean, args.length_sd, reads_per_contig[contig_id])), args.min_length, args.max_length).astype(int)
+			starts = np.sort(rng.integers(0, len(reference_seq) - args.max_length - 10, reads_per_contig[contig_id]))
+			for start, length in zip(starts.tolist(), lengths.tolist()) :
+				sequence, cigar = simulate_read(reference_seq, start, length, args, rng)
+				is_reverse = rng.random() >= args.forward_fraction
+				# Damage happens on the molecule, which is the reverse complement of the read for reverse mapped reads
+				if is_reverse :
+					sequence = deaminate(sequence.translate(COMPLEMENT)[::-1], args.deamination, args.strandness, rng).translate(COMPLEMENT)[::-1]
+				else :
+					sequence = deaminate(sequence, args.deamination, args.strandness, rng)
+				mismatches = np.flatnonzero(rng.random(len(sequence)) < args.mismatch_rate).tolist()
+				if mismatches :
+					sequence = list(sequence)
+					for pos in mismatches :
+						sequence[pos] = str(rng.choice(mismatch_bases))
+					sequence = ''.join(sequence)
+				read = pysam.AlignedSegment()
+				read.query_name = f"read_{read_number}"
+				read.query_sequence = sequence
+				read.flag = 16 if is_reverse else 0
+				read.reference_id = contig_id
+				read.reference_start = start
+				read.mapping_quality = int(rng.integers(0, 61))
+				read.cigartuples = cigar
+				read.query_qualities = pysam.qualitystring_to_array(''.join(chr(33 + q) for q in rng.integers(20, 41, len(sequence)).tolist()))
+				read.set_tag('RG', 'bench')
+				if rng.random() < args.unmapped_fraction : # Unmapped reads placed next to their (imaginary) mate
+					read.flag = 4
+					read.cigartuples = None
+					read.mapping_quality = 0
+				out_file.write(read)
+				read_number += 1
+	pysam.index(bam_file)
+
+# Checksums over the content of all reads (independent of compression and file format), one over the name, flag, position,
+# CIGAR and sequence and one over the base qualities, plus the number of reads
+def read_checksum(output_file) :
+	checksum = hashlib.md5()
+	qualities_checksum = hashlib.md5()
+	reads = 0
+	with pysam.AlignmentFile(output_file, 'r') as in_file :
+		for read in in_file :
+			qualities = read.query_qualities
+			checksum.update(f"{read.query_name}\t{read.flag}\t{read.reference_id}\t{read.reference_start}\t{read.cigarstring}\t{read.query_sequence}\n".encode())
+			qualities_checksum.update((b'*' if qualities is None else bytes(qualities)) + b'\n')
+			reads += 1
+	return checksum.hexdigest(), qualities_checksum.hexdigest(), reads
+
+# Read the last analysis of an edit distance stats tsv file, as the total number of reads and the counts of every column
+# (with the trailing zero counts left out, so files with a different number of rows can be compared)
+def read_stats(stats_file) :
+	with open(stats_file) as f :
+		lines = f.read().splitlines()
+	first = max(i for i, line in enumerate(lines) if line.startswith("Analysis for"))
+	columns = {'total_reads': [int(lines[first].rsplit(':', 1)[1])]}
+	names = lines[first+1].split('\t')
+	rows = [[int(field) for field in line.split('\t')] for line in lines[first+2:] if line.strip()]
+	for column, name in enumerate(names[1:], 1) :
+		counts = [row[column] for row in rows]
+		while counts and counts[-1] == 0 :
+			counts.pop()
+		columns[name] = counts
+	return columns
+
+# Run one masking configuration, and measure the wall time and the peak memory of that process alone
+def run_masker(script, bam_file, fasta_file, output_file, masking, strandness, ref_guided, extra_args) :
+	command = [sys.executable, script, '-i', bam_file, '-o', output_file, '-m', masking, '-s', strandness, '-e', '5']
+	if ref_guided :
+		command += ['-r', fasta_file]
+	command += extra_args
+	start = time.perf_counter()
+	process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+	pid, status, usage = os.wait4(process.pid, 0)
+	wall_time = time.perf_counter() - start
+	error = process.stderr.read().decode()
+	process.stderr.close()
+	result = {'command': ' '.join(shlex.quote(part) for part in command), 'wall_time': round(wall_time, 3), 'peak_rss_mb': round(usage.ru_maxrss / 1024, 1)}
+	if os.waitstatus_to_exitcode(status) != 0 or not os.path.exists(output_file) :
+		result['error'] = error.strip().splitlines()[-1] if error.strip() else f"exit code {os.waitstatus_to_exitcode(status)}"
+		return result
+	try:
+		result['checksum'], result['qualities_checksum'], result['reads_written'] = read_checksum(output_file)
+	except (OSError, ValueError) as error : # e.g. reads written with a sequence that doesn't match their CIGAR
+		result['error'] = f"Output could not be read back: {error}"
+		return result
+	stats_file = output_file + "_stats.tsv"
+	if os.path.exists(stats_file) :
+		result['stats'] = read_stats(stats_file)
+	return result
+
+def main() :
+	script_dir = os.path.dirname(os.path.abspath(__file__))
+	parser = argparse.ArgumentParser(description='Benchmark DamageMasker on a synthetic ancient DNA data set, for every masking mode', add_help=False)
+	parser.add_argument('--script', default=os.path.join(os.path.dirname(script_dir), 'DamageMasker.py'), metavar='', help='DamageMasker script to benchmark (default: ../DamageMasker.py)')
+	parser.add_argument('--baseline', default="NA", metavar='', help='Second DamageMasker script to compare the output and speed against (default: none)')
+	parser.add_argument('--extra_args', default="", metavar='', help='Additional options handed to the benchmarked script only, e.g. "--threads 4" (default: none)')
+	parser.add_argument('--masking', default="HESF", metavar='', help='Masking modes to run (default: HESF)')
+	parser.add_argument('--reads', type=int, default=100000, metavar='', help='Number of simulated reads (default: 100000)')
+	parser.add_argument('--contigs', type=int, default=3, metavar='', help='Number of reference contigs (default: 3)')
+	parser.add_argument('--contig_length', type=int, default=1000000, metavar='', help='Length of every reference contig (default: 1000000)')
+	parser.add_argument('--length_mean', type=float, default=55, metavar='', help='Mean read length (default: 55)')
+	parser.add_argument('--length_sd', type=float, default=20, metavar='', help='Standard deviation of the read length (default: 20)')
+	parser.add_argument('--min_length', type=int, default=25, metavar='', help='Minimum read length (default: 25)')
+	parser.add_argument('--max_length', type=int, default=150, metavar='', help='Maximum read length (default: 150)')
+	parser.add_argument('--indel_rate', type=float, default=0.05, metavar='', help='Fraction of reads with an insertion or deletion (default: 0.05)')
+	parser.add_argument('--clip_rate', type=float, default=0.1, metavar='', help='Chance of a soft clip, for each end of a read (default: 0.1)')
+	parser.add_argument('--forward_fraction', type=float, default=0.5, metavar='', help='Fraction of forward mapped reads (default: 0.5)')
+	parser.add_argument('--deamination', type=float, default=0.3, metavar='', help='C>T (G>A) rate at the first base of a molecule, halving with every base further in (default: 0.3)')
+	parser.add_argument('--strandness', default="D", metavar='', help='Damage pattern of the simulated library, \'S\' or \'D\' (default: D)')
+	parser.add_argument('--mismatch_rate', type=float, default=0.005, metavar='', help='Rate of random mismatches per base (default: 0.005)')
+	parser.add_argument('--unmapped_fraction', type=float, default=0.01, metavar='', help='Fraction of unmapped reads (default: 0.01)')
+	parser.add_argument('--baseline_compatible', action='store_true', help='Simulate reads without soft clips and indels (--clip_rate 0 --indel_rate 0), which DamageMasker up to v1.1 can mask against a reference as well')
+	parser.add_argument('--seed', type=int, default=1, metavar='', help='Random seed, the same seed always gives the same data set (default: 1)')
+	parser.add_argument('--work_dir', default="NA", metavar='', help='Folder to keep the data set and outputs in (default: a temporary folder that is removed afterwards)')
+	parser.add_argument('--output', default="-", metavar='', help='JSON report file (default: stdout)')
+	parser.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='Show this help message and exit.')
+	args = parser.parse_args()
+	args.strandness = args.strandness.upper()
+	if args.baseline_compatible :
+		args.clip_rate = 0
+		args.indel_rate = 0
+
+	tmp_dir = None
+	if args.work_dir == "NA" :
+		tmp_dir = tempfile.TemporaryDirectory(prefix='DamageMasker_benchmark.')
+		args.work_dir = tmp_dir.name
+	os.makedirs(args.work_dir, exist_ok=True)
+
+	# Generate the data set
+	rng = np.random.default_rng(args.seed)
+	fasta_file = os.path.join(args.work_dir, 'synthetic.fasta')
+	bam_file = os.path.join(args.work_dir, 'synthetic.bam')
+	start = time.perf_counter()
+	reference = generate_reference(fasta_file, args.contigs, args.contig_length, rng)
+	generate_bam(bam_file, reference, args, rng)
+	print(f"Generated {args.reads} reads in {time.perf_counter() - start:.1f} seconds ({bam_file})", file=sys.stderr)
+
+	scripts = {'candidate': args.script}
+	if not args.baseline == "NA" :
+		scripts['baseline'] = args.baseline
+	report = {'data_set': {key: value for key, value in vars(args).items() if not key in ['script', 'baseline', 'extra_args', 'work_dir', 'output']},
+		'candidate': args.script, 'baseline': None if args.baseline == "NA" else args.baseline, 'extra_args': args.extra_args, 'runs': []}
+
+	for masking in args.masking.upper() :
+		for strandness in ["S", "D"] :
+			for ref_guided in [False, True] :
+				run = {'masking': masking, 'strandness': strandness, 'ref_guided': ref_guided}
+				for name, script in scripts.items() :
+					output_file = os.path.join(args.work_dir, f"{name}_{masking}{strandness}{'R' if ref_guided else ''}.bam")
+					extra_args = shlex.split(args.extra_args) if name == 'candidate' else []
+					result = run_masker(script, bam_file, fasta_file, output_file, masking, strandness, ref_guided, extra_args)
+					result['reads_per_second'] = round(args.reads / result['wall_time'], 1)
+					run[name] = result
+					print(f"{name}\t-m {masking} -s {strandness}{' -r' if ref_guided else ''}\t{result['wall_time']:.2f} s\t{result['reads_per_second']:.0f} reads/s\t{result['peak_rss_mb']} MB\t{result.get('error', result.get('checksum'))}", file=sys.stderr)
+				if 'baseline' in run and not 'error' in run['baseline'] and not 'error' in run['candidate'] :
+					run['identical_reads'] = run['candidate']['checksum'] == run['baseline']['checksum']
+					run['identical_qualities'] = run['candidate']['qualities_checksum'] == run['baseline']['qualities_checksum']
+					if 'stats' in run['baseline'] :
+						candidate_stats = run['candidate'].get('stats', {})
+						run['identical_stats'] = {name: candidate_stats.get(name) == counts for name, counts in run['baseline']['stats'].items()}
+					run['speedup'] = round(run['baseline']['wall_time'] / run['candidate']['wall_time'], 2)
+				report['runs'].append(run)
+
+	if args.output == "-" :
+		json.dump(report, sys.stdout, indent=1)
+		print()
+	else :
+		with open(args.output, "w") as o:
+			json.dump(report, o, indent=1)
+	if tmp_dir is not None :
+		tmp_dir.cleanup()
+
+if __name__ == "__main__" :
+	main()
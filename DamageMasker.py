@@ -23,6 +23,8 @@
 # Example: python DamageMasker.py --input_file Sample.processed.bam --ref_file Reference.fasta --output_file Sample_RefGuidedmasked.bam
 # Optional: The user can also remove reads that are too short (default 0bp), or are not mapping with a high enough MapQ score (default 0) using the 'Filtering' option (-m F)
 # Example: python DamageMasker.py --input_file Sample.processed.bam --output_file Sample_OnlyFiltered.bam --masking F --mapq_cutoff 37 --len_cutoff 25
+# Optional: A reference used for many samples can be packed once, reference guided runs then memory map it instead of reading the FASTA file every time
+# Example: python DamageMasker.py index Reference.fasta
 
 # If python > v3 is installed as python3, make sure to run the software as 'python3 DamageMasker.py --input_file etc'
 
@@ -30,19 +32,21 @@
 
 import os
 import sys
-import math
+import gzip
+import json
+import mmap
+import queue
+import time
+import shutil
+import struct
 import argparse
-
-# Set scoring variables for reference guided masking
-nuc_fwd_dmg = {}
-nuc_rev_dmg = {}
-nuc_fwd_ins = {}
-nuc_rev_ins = {}
-nuc_fwd_mm = {}
-nuc_rev_mm = {}
-nuc_fwd_tot = {}
-nuc_rev_tot = {}
-nuc_total = {"Total":0}
+import tempfile
+import threading
+import itertools
+import contextlib
+import multiprocessing
+from operator import attrgetter
+from collections import OrderedDict
 
 # Check if the script is running with Python 3 since there is some python3 specific print statement further down the script
 if sys.version_info.major < 3 or int(sys.version[:1]) < 3:
@@ -53,16 +57,259 @@ if sys.version_info.major < 3 or int(sys.version[:1]) < 3:
 try:
 	import pysam
 except ImportError:
+	if not __name__ == "__main__" : # Imported as a module, leave it to the importing script
+		raise
 	print("\nError: This script requires pysam to be installed.\nTry \'pip install pysam\' or \'pip3 install pysam\' (depending on your setup) to install it.\n\n")
 	sys.exit(1)
 
-# Check if the pysam library is installed
+# Check if the numpy library is installed
 try:
-	from Bio import SeqIO
+	import numpy as np
 except ImportError:
-	print("\nError: This script requires biopython to be installed.\nTry \'pip install biopython\' or \'pip3 install biopython\' (depending on your setup) to install it.\n\n")
+	if not __name__ == "__main__" : # Imported as a module, leave it to the importing script
+		raise
+	print("\nError: This script requires numpy to be installed.\nTry \'pip install numpy\' or \'pip3 install numpy\' (depending on your setup) to install it.\n\n")
 	sys.exit(1)
 
+# Raised for everything that stops DamageMasker from masking (unknown settings, missing files, a reference that doesn't match the reads)
+class DamageMaskerError(Exception) :
+	pass
+
+# Reference backend for reference guided masking. Contigs are decoded once into (uppercase) bytes and kept in memory,
+# so every read afterwards is just a slice, instead of re-parsing the contig record from disk for every read.
+# Coordinate sorted input streams contig by contig (previous contigs are evicted least-recently-used first once
+# the memory cap is reached). Unsorted input keeps whole contigs only if the entire genome fits within the cap,
+# otherwise it falls back to faidx random access of just the read window, so contigs are never reloaded over and over.
+class ReferenceCache :
+
+	def __init__(self, ref_file, sorted_input=True, cache_mb=1024) :
+		try:
+			self.fasta = pysam.FastaFile(ref_file) # Builds the .fai index next to the FASTA if it doesn't exist yet
+		except (OSError, ValueError) :
+			raise DamageMaskerError(f"The reference file {ref_file} could not be opened as an (indexed) FASTA file.\n"
+				f"Please make sure it is a plain or bgzip compressed FASTA file, and that a .fai index exists or can be written next to it (samtools faidx {ref_file}).")
+		self.lengths = dict(zip(self.fasta.references, self.fasta.lengths))
+		self.cache = OrderedDict()
+		self.cache_size = 0
+		self.cache_cap = cache_mb * 1024 * 1024
+		self.fits_cap = sum(self.lengths.values()) <= self.cache_cap
+		self.set_sorted(sorted_input)
+
+	# Whole contigs are only worth loading when reads arrive contig by contig, or when nothing ever has to be evicted.
+	# A reference shared between samples switches its access mode per sample, contigs already in the cache stay there
+	def set_sorted(self, sorted_input) :
+		self.load_contigs = sorted_input or self.fits_cap
+
+	# Return the reference bases between start and end (0-based, end exclusive) as uppercase bytes
+	def fetch(self, contig, start, end) :
+		seq = self.cache.get(contig)
+		if seq is None :
+			length = self.lengths[contig] # Raises a KeyError if the contig is not part of the reference
+			if not self.load_contigs or length > self.cache_cap :
+				return self.fasta.fetch(contig, start, end).upper().encode()
+			seq = self.load(contig, length)
+		else :
+			self.cache.move_to_end(contig)
+		return seq[start:end]
+
+	# Return a complete contig as uppercase bytes, if it is kept in memory in the current access mode (None otherwise, fetch windows instead)
+	def contig(self, contig) :
+		seq = self.cache.get(contig)
+		if seq is not None :
+			self.cache.move_to_end(contig)
+			return seq
+		length = self.lengths[contig] # Raises a KeyError if the contig is not part of the reference
+		if not self.load_contigs or length > self.cache_cap :
+			return None
+		return self.load(contig, length)
+
+	# Decode a complete contig into the cache, evicting the least recently used contigs until it fits
+	def load(self, contig, length) :
+		while self.cache and self.cache_size + length > self.cache_cap :
+			evicted_contig, evicted_seq = self.cache.popitem(last=False)
+			self.cache_size -= len(evicted_seq)
+		seq = self.fasta.fetch(contig).upper().encode()
+		self.cache[contig] = seq
+		self.cache_size += len(seq)
+		return seq
+
+	def close(self) :
+		self.fasta.close()
+
+# Packed reference written by 'DamageMasker.py index', all contigs stored as uppercase bases (one uint8 per base) one after the other,
+# behind a small json header with the offset and length of every contig. Masking runs memory map the file, so a reference window is
+# a numpy view on the mapped file (nothing is parsed, decoded or copied), and all jobs on a node share one copy through the page cache
+PACKED_REFERENCE_MAGIC = b"DMREF001"
+
+def packed_reference_name(ref_file) :
+	return ref_file + ".dmref"
+
+# Write the packed reference of a FASTA file, one contig at a time, the FASTA size and modification time are stored
+# so masking runs can tell if the packed reference is still up to date
+def write_packed_reference(ref_file, packed_file) :
+	try:
+		fasta = pysam.FastaFile(ref_file)
+	except (OSError, ValueError) :
+		raise DamageMaskerError(f"The reference file {ref_file} could not be opened as an (indexed) FASTA file.\n"
+			f"Please make sure it is a plain or bgzip compressed FASTA file, and that a .fai index exists or can be written next to it (samtools faidx {ref_file}).")
+	with fasta :
+		contigs = []
+		offset = 0
+		for contig, length in zip(fasta.references, fasta.lengths) :
+			contigs.append([contig, offset, length])
+			offset += length
+		header = json.dumps({'fasta': os.path.abspath(ref_file), 'fasta_size': os.path.getsize(ref_file), 'fasta_mtime': os.path.getmtime(ref_file), 'contigs': contigs}).encode()
+		data_start = -(-(len(PACKED_REFERENCE_MAGIC) + 8 + len(header)) // 4096) * 4096 # The bases start on a page boundary
+		tmp_file = packed_file + ".tmp"
+		with open(tmp_file, "wb") as o:
+			o.write(PACKED_REFERENCE_MAGIC + data_start.to_bytes(8, 'little') + header)
+			o.write(b"\0" * (data_start - o.tell()))
+			for contig in fasta.references :
+				o.write(fasta.fetch(contig).upper().encode())
+		os.replace(tmp_file, packed_file)
+	return len(contigs), offset
+
+class PackedReference :
+
+	def __init__(self, packed_file) :
+		try:
+			with open(packed_file, "rb") as f:
+				if not f.read(len(PACKED_REFERENCE_MAGIC)) == PACKED_REFERENCE_MAGIC :
+					raise ValueError
+				data_start = int.from_bytes(f.read(8), 'little')
+				self.header = json.loads(f.read(data_start - len(PACKED_REFERENCE_MAGIC) - 8).rstrip(b"\0"))
+				self.data = np.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), dtype=np.uint8)
+		except (OSError, ValueError) :
+			raise DamageMaskerError(f"The packed reference {packed_file} could not be read, please recreate it with 'python DamageMasker.py index {packed_file[:-len('.dmref')]}'.")
+		self.contigs = {contig:(data_start + offset, length) for contig, offset, length in self.header['contigs']}
+
+	# Is this packed reference made from the current version of the FASTA file
+	def is_current(self, ref_file) :
+		return os.path.getsize(ref_file) == self.header['fasta_size'] and os.path.getmtime(ref_file) == self.header['fasta_mtime']
+
+	# Return the reference bases between start and end (0-based, end exclusive) as a uint8 view
+	def fetch(self, contig, start, end) :
+		offset, length = self.contigs[contig] # Raises a KeyError if the contig is not part of the reference
+		return self.data[offset + start:offset + min(end, length)]
+
+	# Return a complete contig as a uint8 view
+	def contig(self, contig) :
+		offset, length = self.contigs[contig] # Raises a KeyError if the contig is not part of the reference
+		return self.data[offset:offset + length]
+
+	# The sort order doesn't matter for a memory mapped reference, the page cache takes care of it
+	def set_sorted(self, sorted_input) :
+		pass
+
+	def close(self) :
+		self.data = None # The memory map is closed once the last view on it is gone
+
+# Open the reference for reference guided masking. A packed reference (made with 'DamageMasker.py index') is memory mapped,
+# either when it is given directly or when an up to date one is found next to the FASTA file, otherwise the FASTA file is read
+def open_reference_file(ref_file, sorted_input=True, cache_mb=1024) :
+	if ref_file.endswith(".dmref") :
+		return PackedReference(ref_file)
+	if os.path.exists(packed_reference_name(ref_file)) :
+		reference = PackedReference(packed_reference_name(ref_file))
+		if reference.is_current(ref_file) :
+			return reference
+		reference.close()
+		print(f"Warning: The packed reference {packed_reference_name(ref_file)} is older than {ref_file} and is not used, recreate it with 'python DamageMasker.py index {ref_file}'.", file=sys.stderr)
+	return ReferenceCache(ref_file, sorted_input, cache_mb)
+
+# Target panel index for --sites, the positions of a BED file (0-based, end exclusive) or VCF file (1-based POS, spanning the REF allele),
+# plain text or (b)gzip compressed. Sites are merged into sorted, non-overlapping intervals, stored as two numpy arrays
+# (starts and ends) per contig, so looking up which sites a read overlaps is a binary search, done for a whole batch at once
+class SiteIndex :
+
+	def __init__(self, sites_file) :
+		if not os.path.exists(sites_file) :
+			raise DamageMaskerError(f"Sites file '{sites_file}' not found.")
+		is_vcf = '.vcf' in sites_file.lower()
+		intervals = {}
+		try:
+			with (gzip.open(sites_file, 'rt') if sites_file.endswith('.gz') else open(sites_file)) as f :
+				for line in f :
+					if line.startswith(('#', 'track', 'browser')) or not line.strip() :
+						continue
+					fields = line.rstrip('\n').split('\t')
+					if is_vcf :
+						start = int(fields[1]) - 1
+						end = start + max(len(fields[3]), 1)
+					else :
+						start, end = int(fields[1]), int(fields[2])
+					intervals.setdefault(fields[0], []).append((start, end))
+		except (IndexError, ValueError, OSError) :
+			raise DamageMaskerError(f"The sites file {sites_file} could not be read as a {'VCF' if is_vcf else 'BED'} file.\n"
+				"Please make sure it is a tab separated BED file (chrom, start, end) or a VCF file, either plain text or (b)gzip compressed.")
+
+		self.starts = {}
+		self.ends = {}
+		self.site_count = 0
+		for contig, contig_intervals in intervals.items() :
+			contig_intervals.sort()
+			merged = [list(contig_intervals[0])]
+			for start, end in contig_intervals[1:] :
+				if start <= merged[-1][1] :
+					merged[-1][1] = max(merged[-1][1], end)
+				else :
+					merged.append([start, end])
+			merged = np.array(merged, dtype=np.int64)
+			self.starts[contig] = merged[:, 0]
+			self.ends[contig] = merged[:, 1]
+			self.site_count += int((merged[:, 1] - merged[:, 0]).sum())
+
+	# For every read of a batch, the read offsets of the bases that are aligned to a site (an empty list for reads without any).
+	# Candidate sites are looked up per contig for the whole batch at once, only reads that overlap a site get their CIGAR walked
+	def batch_offsets(self, batch) :
+		site_offsets = [[] for read in batch]
+		reads_per_contig = {}
+		for i, read in enumerate(batch) :
+			reads_per_contig.setdefault(read.reference_name, []).append(i)
+		for contig, read_index in reads_per_contig.items() :
+			starts = self.starts.get(contig)
+			if starts is None :
+				continue
+			ends = self.ends[contig]
+			read_starts = np.fromiter((batch[i].reference_start for i in read_index), dtype=np.int64, count=len(read_index))
+			read_ends = np.fromiter((batch[i].reference_end or batch[i].reference_start for i in read_index), dtype=np.int64, count=len(read_index))
+			first = np.searchsorted(ends, read_starts, side='right') # First site ending after the read start
+			last = np.searchsorted(starts, read_ends, side='left') # Sites starting before the read end
+			for i, lo, hi in zip(read_index, first.tolist(), last.tolist()) :
+				if lo < hi :
+					site_offsets[i] = aligned_site_offsets(batch[i].cigartuples, batch[i].reference_start, starts[lo:hi].tolist(), ends[lo:hi].tolist())
+		return site_offsets
+
+# Walk the CIGAR of a read and return the read offsets of the bases aligned (M/=/X) to any of the given sites
+def aligned_site_offsets(cigartuples, reference_start, site_starts, site_ends) :
+	offsets = []
+	ref_pos = reference_start
+	read_pos = 0
+	for operation, length in cigartuples :
+		if operation == 0 or operation == 7 or operation == 8 :
+			block_end = ref_pos + length
+			for start, end in zip(site_starts, site_ends) :
+				start = max(start, ref_pos)
+				end = min(end, block_end)
+				if start < end :
+					offsets.extend(range(read_pos + start - ref_pos, read_pos + end - ref_pos))
+			ref_pos = block_end
+			read_pos += length
+		elif operation == 1 or operation == 4 :
+			read_pos += length
+		elif operation == 2 or operation == 3 :
+			ref_pos += length
+	return offsets
+
+# Base name for the additional stats files, these are stored next to the output file,
+# or named after the input file (in the working directory) when the output is streamed to stdout
+def stats_file_name(args) :
+	if not args.output_file == '-' :
+		return args.output_file
+	if not args.input_file == '-' :
+		return os.path.basename(args.input_file)
+	return "DamageMasker"
+
 # Generate an STDout with the settings chosen, for reproducibility, and troubleshooting purposes
 def settings_summary_printer(args) :
 
@@ -72,186 +319,1859 @@ def settings_summary_printer(args) :
 		print(f"Reference used: {args.ref_file}")
 	if args.masking == "E" :
 		print(f"Masking type: Edge masking (default)")
-		print(f"Number of edge bases masked: {args.edge_count}")
+		if args.auto_edge :
+			print(f"Number of edge bases masked: calibrated on {args.auto_edge_reads:,} sampled reads, up to where the damage is less than {args.auto_edge_threshold} above the background")
+		else :
+			print(f"Number of edge bases masked: {args.edge_count}")
 	if args.masking == "H" :
 		print(f"Masking type: Hard masking")
+	if args.masking == "S" :
+		print(f"Masking type: Soft masking")
+	if args.masking == "S" or args.soft_mask :
+		print(f"Masked bases keep their base, but get a base quality of: {args.mask_quality}")
+	if args.region is not None or args.regions_file is not None :
+		print(f"Only processing the reads in: {', '.join((args.region or []) + ([args.regions_file] if args.regions_file is not None else []))}")
+	if args.sites is not None :
+		print(f"Only masking bases on the panel sites in: {args.sites}")
+	if args.rg_config is not None :
+		print(f"Read groups listed in {args.rg_config} are masked with their own settings, statistics per read group are stored to: {stats_file_name(args)}_read_groups.tsv")
 	if not args.mapq_cutoff == 0 :
 		print(f"Remove reads with MapQ score below: {args.mapq_cutoff}")
 	if not args.len_cutoff == 0 :
 		print(f"Remove reads reads with length below: {args.len_cutoff} bp")
-	print(f"Masked SAM/BAM will be saved to: {args.output_file}")
+	if args.calmd :
+		print(f"MD and NM tags are recomputed for the masked reads")
+	if args.strip_tags :
+		print(f"Tags removed from all reads: {args.strip_tags}")
+	if args.threads > 1 :
+		print(f"Worker processes: {args.threads}")
+	print(f"Masked SAM/BAM/CRAM will be saved to: {args.output_file if not args.output_file == '-' else 'stdout'} ({args.output_format})")
+	if args.keep_filtered :
+		print(f"Reads removed by the filters are kept in the output, unmasked")
+	if args.filtered_output is not None :
+		print(f"Reads removed by the filters will be saved to: {args.filtered_output} ({args.output_format}, unmasked)")
+	if args.write_index :
+		print(f"The output will be indexed")
+	if args.checkpoint :
+		print(f"Checkpoints are saved every {args.checkpoint:g} seconds to: {args.output_file}.checkpoint{' (resuming from the last one)' if args.resume else ''}")
 	if not args.ref_file =="NA":
-		print(f"Additional edit distance analysis is stored to: {args.output_file}_stats.tsv")
+		print(f"Additional edit distance analysis is stored to: {stats_file_name(args)}_stats.tsv")
+		print(f"Positional damage profile is stored to: {stats_file_name(args)}_damage_profile.tsv (both combined in {stats_file_name(args)}_stats.json)")
 	print() # Just a paragraph breaker
 
 
-# Determine if a bam or sam is provided
-def sam_bam_picker(input_file,ref_file,output_file,mapq_cutoff,len_cutoff,masking,edge_count, strandness) :
+# The FASTA file htslib reads the reference of CRAM files from. The reference given for reference guided masking is used for
+# decoding and encoding CRAM as well, a packed reference (.dmref) points back to the FASTA file it was made from
+def cram_reference(ref_file) :
+	if ref_file.endswith(".dmref") :
+		reference = PackedReference(ref_file)
+		ref_file = reference.header['fasta']
+		reference.close()
+	return ref_file
 
-	# Check if  is mapped and MAPQ is above the cutoff
-	if '.sam' in input_file :
-		with pysam.AlignmentFile(input_file, 'r') as sam, pysam.AlignmentFile(output_file, 'w', header=sam.header) as output_sam :
-			process_sam_bam(sam, output_sam, input_file, ref_file, output_file, mapq_cutoff, len_cutoff, masking, edge_count, strandness)
+# Open a SAM/BAM/CRAM file for reading, the format is recognized from the file content. CRAM files are decoded with the reference
+# when one is given, otherwise htslib looks the reference up itself (the UR and M5 tags of the header, see REF_PATH in the samtools docs)
+def open_input(input_file, ref_file="NA", io_threads=1) :
+	options = {'threads':io_threads}
+	if not ref_file == "NA" :
+		options['reference_filename'] = cram_reference(ref_file)
+	verbosity = pysam.set_verbosity(0) # pysam always tries to load the index of a CRAM file, and htslib complains when there is none
+	try:
+		return pysam.AlignmentFile(input_file, 'r', **options)
+	except (OSError, ValueError) as error :
+		raise DamageMaskerError(f"The input file '{input_file}' could not be opened as a SAM, BAM or CRAM file ({error}).")
+	finally:
+		pysam.set_verbosity(verbosity)
 
-	elif '.bam' in input_file :
-		with pysam.AlignmentFile(input_file, 'rb') as bam, pysam.AlignmentFile(output_file, 'wb', header=bam.header) as output_bam :
-			process_sam_bam(bam, output_bam, input_file, ref_file, output_file, mapq_cutoff, len_cutoff, masking, edge_count, strandness)
+# htslib open modes for every output format, 'ubam' is uncompressed BAM (fastest to pipe into samtools and co.)
+output_modes = {'sam':'w', 'bam':'wb', 'ubam':'wbu', 'cram':'wc'}
+output_extentions = {'sam':'.sam', 'bam':'.bam', 'ubam':'.bam', 'cram':'.cram'}
 
-def process_sam_bam(in_file, out_file, input_file, ref_file, output_file, mapq_cutoff, len_cutoff, masking, edge_count, strandness) :
+# Index on write for BAM output, a BAI index is built from the BGZF virtual offset (tell()) after every read that is written,
+# so the output doesn't need to be read again by samtools index. Wraps the output file, reads are written through write().
+# The virtual offsets are only known while compressing on a single thread, and BAI only covers contigs up to 2^29 bp,
+# other outputs are indexed by pysam (samtools index) after writing instead (see index_output)
+class BamIndexWriter :
 
-	# Set the masking options to uppercase
-	masking = masking.upper()
-	
-	if not ref_file =="NA" :
-		# Load the reference genome
-		reference_dict = SeqIO.index(ref_file, "fasta")
-
-	# Go through the reads in the FASTA
-	for read in in_file :
-		if not read.is_unmapped and read.mapping_quality >= mapq_cutoff and read.query_length >= len_cutoff :
-			nuc_total['Total'] += 1 # Just counting the number of processed reads
-			read_sequence = read.query_sequence # Get read sequence
-#			modified_qualities = read.query_qualities # Obtain the original quality values
-
-			if not ref_file =="NA" and not masking == "F" :
-				# Load the reference sequence
-				try:
-					reference_seq = reference_dict[read.reference_name][read.reference_start:read.reference_end] # Get reference sequence
-				except:
-					print(f"\nError: It appears either the Reference file {ref_file} is not formatted as a FASTA file, or the header does not match that of the supplied SAM/BAM file.")
-					print(f"Please make sure the reference file is the same as the one used in your mapping strategy that produced the SAM/BAM file.\n\n")
-					sys.exit(1)
-
-				# Deal with indels (annoying!!!)
-				if len(read.cigartuples)>1 :
-					pos_slider=0 # The cigar tuples give match (0), insertion (1) and deletion (2) information in tuples
-					# and example would be [(0, 16), (2, 1), (0, 60)]. Here there are 16 matches, 1 deletion (of 1bp) in the read, and 60 more matches
-					# Or [(0, 1), (1, 1), (0, 74)]. Here there is one match, 1 insertion (of additional nucleotide), and 74 more matches
-					for cigar in read.cigartuples :
-						if cigar[0] == 0 : 
-							pos_slider += cigar[1]
-						elif cigar[0] == 1 : # Add spacer to reference if a insertion occured in the read
-							toggle=1
-							reference_seq.seq = reference_seq.seq[:pos_slider] + ("-"*cigar[1]) + reference_seq.seq[pos_slider:]
-							pos_slider += cigar[1]
-						elif cigar[0] == 2 : # Add spacer to read if a deletion occured in the read
-							read_sequence = read_sequence[:pos_slider] + ("-"*cigar[1]) + read_sequence[pos_slider:]
-							pos_slider += cigar[1]
-
-				calc_indel= read_sequence.count('-') # Calculate number of indels in read for scoring
-				nuc_rev_ins[str(calc_indel)] = nuc_rev_ins.get(str(calc_indel), 0) + 1
-
-				# Forward read, default is Hard Masking
-				if not read.is_reverse :
-					if strandness == "D" :
-						modified_sequence = ''.join(['N' if (ref == 'C' and read == 'T') or (ref == 'G' and read == 'A') else read for ref, read in zip(reference_seq, read_sequence)])
-					else :
-						modified_sequence = ''.join(['N' if ref == 'C' and read == 'T' else read for ref, read in zip(reference_seq, read_sequence)])
-					calc_CT = modified_sequence.count('N') # Calculate number of C>T transversions in read for scoring
-					nuc_fwd_dmg[str(calc_CT)] = nuc_fwd_dmg.get(str(calc_CT), 0) + 1
-					calc_MM = ''.join(['Z' if ref != read and not read in ['N','-'] else read for ref, read in zip(reference_seq, read_sequence)]).count('Z')
-					nuc_fwd_mm[str(calc_MM)] = nuc_fwd_mm.get(str(calc_MM), 0) + 1
-					num_total = modified_sequence.count('N') + calc_indel + calc_MM
-					nuc_fwd_tot[str(num_total)] = nuc_fwd_tot.get(str(num_total), 0) + 1
-				# Reverse read
+	def __init__(self, out_file, index_file) :
+		self.out_file = out_file
+		self.index_file = index_file
+		self.references = out_file.references
+		self.bins = [{} for reference in self.references] # Per contig, bin: list of [start, end] virtual offset chunks
+		self.linear = [[] for reference in self.references] # Per contig, lowest virtual offset per 16 kb window
+		self.ref_stats = [None for reference in self.references] # Per contig, [first offset, last offset, mapped, unmapped]
+		self.no_coordinate = 0
+		self.last_offset = out_file.tell()
+		self.last_position = (-1, -1)
+
+	def write(self, read) :
+		self.out_file.write(read)
+		start_offset = self.last_offset
+		self.last_offset = end_offset = self.out_file.tell()
+		contig = read.reference_id
+		if contig < 0 :
+			self.no_coordinate += 1
+			return
+		start = read.reference_start
+		if (contig, start) < self.last_position or self.no_coordinate :
+			raise DamageMaskerError(f"Read {read.query_name} ({read.reference_name}:{start+1}) is out of order, the input file is not coordinate sorted and can't be indexed. Please sort it first (samtools sort).")
+		self.last_position = (contig, start)
+		end = read.reference_end if not read.is_unmapped and read.reference_end else start + 1
+
+		chunks = self.bins[contig].setdefault(reg2bin(start, end), [])
+		if chunks and chunks[-1][1] == start_offset :
+			chunks[-1][1] = end_offset
+		else :
+			chunks.append([start_offset, end_offset])
+		linear = self.linear[contig]
+		if len(linear) <= (end - 1) >> 14 :
+			linear.extend([None] * (((end - 1) >> 14) + 1 - len(linear)))
+		for window in range(start >> 14, ((end - 1) >> 14) + 1) :
+			if linear[window] is None :
+				linear[window] = start_offset
+		ref_stats = self.ref_stats[contig]
+		if ref_stats is None :
+			ref_stats = self.ref_stats[contig] = [start_offset, end_offset, 0, 0]
+		ref_stats[1] = end_offset
+		ref_stats[3 if read.is_unmapped else 2] += 1
+
+	# Write the index, in the BAI format of the SAM specification
+	def close(self) :
+		index = [b"BAI\1", struct.pack('<i', len(self.references))]
+		for bins, linear, ref_stats in zip(self.bins, self.linear, self.ref_stats) :
+			index.append(struct.pack('<i', len(bins) + (ref_stats is not None)))
+			for bin_number, chunks in sorted(bins.items()) :
+				index.append(struct.pack('<Ii', bin_number, len(chunks)))
+				index.append(struct.pack(f'<{2*len(chunks)}Q', *[offset for chunk in chunks for offset in chunk]))
+			if ref_stats is not None : # Pseudo bin with the offsets and read counts of the contig
+				index.append(struct.pack('<IiQQQQ', 37450, 2, *ref_stats))
+			# Windows without any read get the offset of the next window that has reads, no read overlapping them comes before that
+			next_offset = 0
+			for window in range(len(linear) - 1, -1, -1) :
+				if linear[window] is None :
+					linear[window] = next_offset
+				next_offset = linear[window]
+			index.append(struct.pack(f'<i{len(linear)}Q', len(linear), *linear))
+		index.append(struct.pack('<Q', self.no_coordinate))
+		with open(self.index_file, "wb") as o:
+			o.write(b''.join(index))
+
+# BAI/CSI bin of a 0-based, end exclusive region (from the SAM specification)
+def reg2bin(start, end) :
+	end -= 1
+	if start >> 14 == end >> 14 :
+		return ((1 << 15) - 1) // 7 + (start >> 14)
+	if start >> 17 == end >> 17 :
+		return ((1 << 12) - 1) // 7 + (start >> 17)
+	if start >> 20 == end >> 20 :
+		return ((1 << 9) - 1) // 7 + (start >> 20)
+	if start >> 23 == end >> 23 :
+		return ((1 << 6) - 1) // 7 + (start >> 23)
+	if start >> 26 == end >> 26 :
+		return ((1 << 3) - 1) // 7 + (start >> 26)
+	return 0
+
+# Index a finished output file with pysam (samtools index), used when the index can't be built while writing.
+# Contigs beyond the 2^29 bp BAI limit get a CSI index
+def index_output(output_file, lengths, io_threads=1) :
+	options = ["-@", str(io_threads)]
+	if max(lengths, default=0) >= 2**29 :
+		options.append("-c")
+	pysam.index(*options, output_file)
+
+# Open the output SAM/BAM/CRAM file, '-' writes to stdout. The compression level only applies to BAM and CRAM,
+# io_threads are handed to htslib for (de)compression
+def open_output(output_file, output_format, header, ref_file="NA", compression_level=None, io_threads=1) :
+	options = {'threads':io_threads}
+	if compression_level is not None and output_format in ['bam', 'cram'] :
+		options['format_options'] = [f"level={compression_level}".encode()]
+	if output_format == 'cram' and not ref_file == "NA" :
+		options['reference_filename'] = cram_reference(ref_file)
+	return pysam.AlignmentFile(output_file, output_modes[output_format], header=header, **options)
+
+# Open the output file of the filtered out reads (--filtered_output) in the same format as the masked output, with None as filtered_output
+# it stands in for it as an empty context, so it can be opened in the same with statement as the masked output
+def open_filtered_output(filtered_output, output_format, header, ref_file="NA", compression_level=None, io_threads=1) :
+	if filtered_output is None :
+		return contextlib.nullcontext()
+	return open_output(filtered_output, output_format, header, ref_file, compression_level, io_threads)
+
+# Checkpoints of a long single core run (--checkpoint), so a run that gets killed (e.g. a preempted cluster node) can be resumed.
+# The output is written as a series of BAM chunks in <output>.checkpoint/, and every interval seconds the current chunk is closed
+# (a finalized BGZF file) and checkpoint.json records the chunks written so far, the virtual offset (tell()) of the input file
+# after the last read in them, and the damage statistics and run metrics up to that point. A resumed run seeks the input file to
+# that offset and carries on with a new chunk, so at most one interval of work is lost. At the end the chunks are concatenated
+# into the output file without recompressing them, and the checkpoint directory is removed
+class Checkpoint :
+
+	def __init__(self, masker, in_file, input_file, output_file, output_format, compression_level=None, io_threads=1, interval=600) :
+		self.masker = masker
+		self.in_file = in_file
+		self.output_file = output_file
+		self.output_format = output_format
+		self.compression_level = compression_level
+		self.io_threads = io_threads
+		self.interval = interval
+		self.dir = output_file + ".checkpoint"
+		self.state_file = os.path.join(self.dir, "checkpoint.json")
+		input_stat = os.stat(input_file)
+		# Everything that has to be the same for a run to continue from this checkpoint (the settings before any calibration)
+		self.run = {'input_file': os.path.abspath(input_file), 'input_size': input_stat.st_size, 'input_mtime': input_stat.st_mtime,
+			'output_format': output_format, 'settings': json.loads(json.dumps(masker.settings))}
+		self.chunks = []
+		self.out_file = None
+		self.last_save = time.perf_counter()
+		self.resumed = False
+
+	# Pick up the last checkpoint of an earlier run of the same input and settings (when resume is set and there is one),
+	# restoring its statistics and seeking the input file to where it stopped. Otherwise any old checkpoint is discarded
+	def load(self, resume) :
+		if not os.path.exists(self.state_file) :
+			if resume :
+				print(f"Warning: No checkpoint was found in {self.dir}, starting from the first read.", file=sys.stderr)
+		elif not resume :
+			print(f"Warning: The checkpoint in {self.dir} is discarded, use --resume to continue from it instead.", file=sys.stderr)
+		else :
+			with open(self.state_file) as f :
+				state = json.load(f)
+			saved = state['run']
+			differing = [name.replace('_', ' ') for name, value in self.run.items() if not name == 'settings' and not saved.get(name) == value]
+			differing += [f"{name} setting" for name, value in self.run['settings'].items() if not saved['settings'].get(name) == value]
+			if differing :
+				raise DamageMaskerError(f"The checkpoint in {self.dir} was made with a different {', '.join(differing)}, so it can't be resumed.\n"
+					f"Run without --resume to start over, or remove {self.dir}.")
+			masker = self.masker
+			masker.edge_count = masker.settings['edge_count'] = state['edge_count']
+			masker.stats.load_state(state['stats'])
+			masker.metrics.load_state(state['metrics'])
+			masker.read_group_stats = {}
+			for read_group, profile, stats_state, metrics_state in state['read_group_stats'] :
+				masker.read_group_stats[read_group] = [profile, DamageStats(masker.stats.profile_length), RunMetrics()]
+				masker.read_group_stats[read_group][1].load_state(stats_state)
+				masker.read_group_stats[read_group][2].load_state(metrics_state)
+			self.chunks = state['chunks']
+			self.in_file.seek(state['offset'])
+			self.resumed = True
+			print(f"Resuming from the checkpoint in {self.dir}, {masker.metrics.counts['seen']:,} reads were processed before.", file=sys.stderr)
+			return
+		shutil.rmtree(self.dir, ignore_errors=True)
+
+	# Open the next chunk, anything left of an unfinished chunk of a killed run is overwritten
+	def open_chunk(self) :
+		os.makedirs(self.dir, exist_ok=True)
+		self.out_file = open_output(os.path.join(self.dir, f"chunk_{len(self.chunks):06d}.bam"), self.output_format, self.in_file.header, compression_level=self.compression_level, io_threads=self.io_threads)
+		return self.out_file
+
+	def due(self) :
+		return time.perf_counter() - self.last_save >= self.interval
+
+	# Close the current chunk and record the checkpoint, returns the next chunk to write to. Only call this between batches,
+	# when every read taken from the input file so far is written
+	def save(self) :
+		self.out_file.close()
+		self.chunks.append(os.path.basename(self.out_file.filename.decode()))
+		masker = self.masker
+		state = {'run': self.run, 'offset': self.in_file.tell(), 'chunks': self.chunks, 'edge_count': masker.edge_count,
+			'stats': masker.stats.state(), 'metrics': masker.metrics.state(),
+			'read_group_stats': [[read_group, profile, stats.state(), metrics.state()] for read_group, (profile, stats, metrics) in masker.read_group_stats.items()]}
+		with open(self.state_file + ".tmp", "w") as o:
+			json.dump(state, o)
+		os.replace(self.state_file + ".tmp", self.state_file) # A checkpoint is either complete or not there at all
+		self.last_save = time.perf_counter()
+		return self.open_chunk()
+
+	# Close the last chunk and put the chunks together into the output file
+	def finish(self) :
+		self.out_file.close()
+		self.chunks.append(os.path.basename(self.out_file.filename.decode()))
+		chunk_files = [os.path.join(self.dir, chunk) for chunk in self.chunks]
+		if len(chunk_files) == 1 :
+			os.replace(chunk_files[0], self.output_file)
+		else :
+			cat_chunks(self.output_file, chunk_files, self.dir)
+		shutil.rmtree(self.dir, ignore_errors=True)
+
+# Parse a samtools style region ('chr1', 'chr1:1000' or 'chr1:1,000-2,000', 1-based and inclusive) into a 0-based, end exclusive
+# (contig, start, end) tuple, using the header of the BAM file. Contig names that contain a ':' themselves are recognized as well
+def parse_region(region, bam) :
+	if region in bam.references :
+		return (region, 0, bam.get_reference_length(region))
+	contig, _, positions = region.rpartition(':')
+	if not contig in bam.references :
+		raise DamageMaskerError(f"The contig of region '{region}' is not part of the SAM/BAM header.")
+	try:
+		start, _, end = positions.replace(',', '').partition('-')
+		start = int(start) - 1
+		end = int(end) if end else bam.get_reference_length(contig)
+	except ValueError :
+		raise DamageMaskerError(f"The region '{region}' is not recognized, please use 'chr', 'chr:start' or 'chr:start-end'.")
+	if start < 0 or end <= start :
+		raise DamageMaskerError(f"The region '{region}' is empty, the start needs to be at least 1 and below the end.")
+	return (contig, start, min(end, bam.get_reference_length(contig)))
+
+# Read the regions of a BED file (0-based, end exclusive) as (contig, start, end) tuples
+def read_regions_file(regions_file) :
+	if not os.path.exists(regions_file) :
+		raise DamageMaskerError(f"Regions file '{regions_file}' not found.")
+	regions = []
+	try:
+		with (gzip.open(regions_file, 'rt') if regions_file.endswith('.gz') else open(regions_file)) as f :
+			for line in f :
+				if line.startswith(('#', 'track', 'browser')) or not line.strip() :
+					continue
+				fields = line.rstrip('\n').split('\t')
+				regions.append((fields[0], int(fields[1]), int(fields[2])))
+	except (IndexError, ValueError, OSError) :
+		raise DamageMaskerError(f"The regions file {regions_file} could not be read as a BED file (chrom, start, end).")
+	return regions
+
+# Sort regions in the order of the contigs in the header and merge the ones that overlap or touch
+def merge_regions(bam, regions) :
+	contig_order = {contig:i for i, contig in enumerate(bam.references)}
+	merged = []
+	for contig, start, end in sorted(regions, key=lambda region: (contig_order.get(region[0], -1), region[1], region[2])) :
+		if not contig in contig_order :
+			raise DamageMaskerError(f"The contig of region '{contig}:{start+1}-{end}' is not part of the SAM/BAM header.")
+		if merged and merged[-1][0] == contig and start <= merged[-1][2] :
+			merged[-1][2] = max(merged[-1][2], end)
+		else :
+			merged.append([contig, start, end])
+	return [tuple(region) for region in merged]
+
+# Split the genome (or a list of sorted, merged regions) into chunks of roughly chunk_size bp, every chunk is a list of (contig, start, end, owned_from) pieces.
+# Large contigs are cut into several chunks, small contigs (scaffolds, decoys, chrM) are grouped together into one chunk.
+# Without regions, contigs without any reads according to the index are skipped entirely.
+# owned_from marks from where a piece owns the reads it overlaps: where the previous piece ends, or where the previous region of the contig ends
+def genome_chunker(bam, chunk_size, regions=None) :
+	if regions is None :
+		regions = contigs_with_reads(bam)
+	chunks = []
+	pieces = []
+	pieces_bp = 0
+	previous_end = {}
+	for contig, region_start, region_end in regions :
+		owned_from = previous_end.get(contig, 0)
+		for start in range(region_start, region_end, chunk_size) :
+			end = min(start + chunk_size, region_end)
+			pieces.append((contig, start, end, owned_from))
+			owned_from = end
+			pieces_bp += end - start
+			if pieces_bp >= chunk_size :
+				chunks.append(pieces)
+				pieces = []
+				pieces_bp = 0
+		previous_end[contig] = region_end
+	if pieces :
+		chunks.append(pieces)
+	return chunks
+
+# The contigs of an indexed SAM/BAM/CRAM file that have reads according to its index, as (contig, 0, length) regions.
+# A CRAM index (.crai) doesn't count the reads per contig, so for CRAM files every contig is included
+def contigs_with_reads(bam) :
+	if bam.is_cram :
+		return [(contig, 0, length) for contig, length in zip(bam.references, bam.lengths)]
+	read_counts = {stat.contig:stat.total for stat in bam.get_index_statistics()}
+	return [(contig, 0, length) for contig, length in zip(bam.references, bam.lengths) if read_counts.get(contig, 0) > 0]
+
+# Yield the reads of a chunk in file order. fetch() returns every read overlapping a piece, so only reads that start at or after
+# owned_from are kept, reads that start before that overlap the previous piece or region as well, and are written by that one.
+# That way a read spanning two chunks or two regions is written exactly once. A ('*', None, None, -1) piece holds the unmapped reads without a position
+def chunk_reads(bam, pieces) :
+	for contig, start, end, owned_from in pieces :
+		for read in bam.fetch(contig, start, end) :
+			if read.reference_start >= owned_from :
+				yield read
+
+# Sample up to n_reads reads spread over an indexed SAM/BAM/CRAM file (or over its regions), as n_slices runs of consecutive reads
+# starting at evenly spaced positions along the contigs that have mapped reads, so the sample doesn't depend on the file size
+def sample_reads(bam, n_reads, regions=None, n_slices=100) :
+	if regions is None :
+		regions = contigs_with_reads(bam)
+	total_length = sum(end - start for contig, start, end in regions)
+	if not total_length :
+		return []
+	width = -(-total_length // n_slices)
+	slices = [(contig, slice_start, min(end, slice_start + width)) for contig, start, end in regions for slice_start in range(start, end, width)]
+	slice_reads = -(-n_reads // len(slices))
+	sample = []
+	for contig, slice_start, slice_end in slices :
+		taken = 0
+		for read in bam.fetch(contig, slice_start, slice_end) :
+			if taken == slice_reads :
+				break
+			if read.reference_start >= slice_start : # Reads starting in an earlier slice belong to that slice
+				sample.append(read)
+				taken += 1
+	return sample[:n_reads]
+
+# Concatenate the compressed chunks of a multi-process run as they are, without decompressing and recompressing the reads.
+# No @PG line is added, so the output is the same as that of a single core run. pysam keeps the stdout of samtools to itself,
+# so for stdout ('-') the chunks are joined in tmp_dir first and then copied to stdout
+def cat_chunks(output_file, chunk_files, tmp_dir) :
+	if not output_file == '-' :
+		pysam.cat("--no-PG", "-o", output_file, *chunk_files)
+		return
+	joined_file = os.path.join(tmp_dir, "joined" + os.path.splitext(chunk_files[0])[1])
+	pysam.cat("--no-PG", "-o", joined_file, *chunk_files)
+	sys.__stdout__.flush()
+	with open(joined_file, "rb") as joined, open(sys.__stdout__.fileno(), "wb", closefd=False) as stdout :
+		shutil.copyfileobj(joined, stdout)
+
+# Every worker process keeps its own masker (and with that its own reference), so reference contigs are decoded once per worker and not once per chunk
+worker_masker = None
+
+def parallel_worker_init(settings) :
+	global worker_masker
+	worker_masker = Masker(**settings)
+	worker_masker.open_reference(True)
+
+# Mask a single chunk into its own temporary BAM file (and its filtered out reads into another one, with filtered_chunk_file),
+# and hand the statistics and metrics of this chunk back to the main process
+def parallel_worker(task) :
+	input_file, pieces, chunk_file, filtered_chunk_file, output_format, compression_level, keep_filtered = task
+	worker_masker.stats = DamageStats(worker_masker.stats.profile_length)
+	worker_masker.metrics = RunMetrics()
+	worker_masker.read_group_stats = {}
+	with open_input(input_file, worker_masker.ref_file) as bam, open_output(chunk_file, output_format, bam.header, worker_masker.ref_file, compression_level) as output_bam :
+		worker_masker.set_read_groups(bam.header)
+		with open_filtered_output(filtered_chunk_file, output_format, bam.header, worker_masker.ref_file, compression_level) as filtered_bam :
+			worker_masker.write_masked_reads(chunk_reads(bam, pieces), output_bam, None, keep_filtered, filtered_bam)
+	return worker_masker.stats, worker_masker.metrics, worker_masker.read_group_stats
+
+# Translation tables for the hard masking fast path, translate swaps all target bases of a whole batch to N in a single call
+HARD_MASK_T = str.maketrans('T', 'N')
+HARD_MASK_A = str.maketrans('A', 'N')
+HARD_MASK_AT = str.maketrans('AT', 'NN')
+BASE_A, BASE_C, BASE_G, BASE_T, BASE_N, BASE_GAP = b'ACGTN-'
+
+# Number of reads that are masked together in one go by the vectorized masking kernel
+BATCH_SIZE = 10000
+
+# A batch of reads (str) packed into one uint8 array (seq_buf), with an offsets table marking where each read starts and ends.
+# ref_buf optionally holds the reference base lined up with every read base (see align_batch_to_reference)
+class PackedBatch :
+
+	def __init__(self, seqs, is_reverse, ref_buf=None) :
+		self.offsets = np.zeros(len(seqs)+1, dtype=np.int64)
+		np.cumsum(np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs)), out=self.offsets[1:])
+		self.lengths = np.diff(self.offsets)
+		self.seq_buf = np.frombuffer(''.join(seqs).encode(), dtype=np.uint8)
+		self.ref_buf = ref_buf
+		self.is_reverse = is_reverse
+		self._read_index = None
+
+	# The read every base belongs to, only built when it's used (edge masking without a reference only looks at the edge windows)
+	@property
+	def read_index(self) :
+		if self._read_index is None :
+			self._read_index = np.repeat(np.arange(len(self.lengths)), self.lengths)
+		return self._read_index
+
+	# Sum a per-base boolean array for every read
+	def read_sums(self, values) :
+		if len(values) == 0 :
+			return np.zeros(len(self.lengths), dtype=np.int64)
+		sums = np.add.reduceat(values.view(np.uint8), np.minimum(self.offsets[:-1], len(values)-1), dtype=np.int64)
+		sums[self.lengths == 0] = 0
+		return sums
+
+	# Count a sparse set of bases (an index into the batch) for every read
+	def index_counts(self, index) :
+		return np.bincount(np.searchsorted(self.offsets, index, side='right') - 1, minlength=len(self.lengths))
+
+	# Return the batch with the bases under mask replaced, as one string (slice it with the offsets table)
+	def masked_seqs(self, mask, base=BASE_N) :
+		masked_buf = self.seq_buf.copy()
+		masked_buf[mask] = base
+		return masked_buf.tobytes().decode()
+
+# Vectorized masking kernel, returns a boolean array marking the bases of a packed batch that are considered damage.
+# Without a reference, every T (C>T) and A (G>A) is a candidate, with a reference only Ts on a reference C and As on a reference G are.
+# Single stranded libraries only look at C>T on forward reads and G>A on reverse reads, double stranded libraries look at both.
+# Edge masking limits C>T to the first and G>A to the last edge_count bases of a read (never more than half the read), so only
+# those windows are looked at and the rest of the batch is never touched.
+# edge_count is either one depth for everything, or a depth per strand (forward, reverse) and molecule end (5', 3'), see edge_counts
+def damage_mask(batch, masking, edge_count, strandness, ref_guided=True) :
+	ref_buf = batch.ref_buf if ref_guided else None
+	if masking == "E" :
+		# Reverse reads are stored reverse complemented, so their first bases are the 3' end of the molecule (a C>T there is a G>A
+		# of the molecule), and their last bases its 5' end
+		depths = edge_counts(edge_count)
+		max_numb = batch.lengths//2 - 1
+		CT_numb = np.clip(np.minimum(np.where(batch.is_reverse, depths[1][1], depths[0][0]), max_numb), 0, None)
+		GA_numb = np.clip(np.minimum(np.where(batch.is_reverse, depths[1][0], depths[0][1]), max_numb), 0, None)
+		if strandness != "D" :
+			CT_numb[batch.is_reverse] = 0
+			GA_numb[~batch.is_reverse] = 0
+		mask = np.zeros(len(batch.seq_buf), dtype=bool)
+		for base, ref_base, index in [(BASE_T, BASE_C, window_index(batch.offsets[:-1], CT_numb)), (BASE_A, BASE_G, window_index(batch.offsets[1:] - GA_numb, GA_numb))] :
+			is_damage = batch.seq_buf[index] == base
+			if ref_buf is not None :
+				is_damage &= ref_buf[index] == ref_base
+			mask[index[is_damage]] = True
+		return mask
+	is_CT = batch.seq_buf == BASE_T
+	is_GA = batch.seq_buf == BASE_A
+	if ref_buf is not None :
+		is_CT &= ref_buf == BASE_C
+		is_GA &= ref_buf == BASE_G
+	if strandness == "D" :
+		return is_CT | is_GA
+	return np.where(batch.is_reverse[batch.read_index], is_GA, is_CT)
+
+# Index (into a packed batch) of every base of a set of windows, given the start and the number of bases of every window
+def window_index(starts, counts) :
+	ends = np.cumsum(counts)
+	return np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - counts), counts)
+
+# The edge masking depth per strand (forward, reverse) and molecule end (5', 3'), from a single depth or such a nested list
+def edge_counts(edge_count) :
+	if isinstance(edge_count, int) :
+		return [[edge_count, edge_count], [edge_count, edge_count]]
+	return edge_count
+
+# Readable form of an edge count, per strand when it differs between the strands or ends. Single stranded libraries
+# are only masked at the 5' end of the molecules, so their 3' depth is left out
+def edge_count_name(edge_count, strandness) :
+	if isinstance(edge_count, int) :
+		return str(edge_count)
+	if strandness.upper() == "S" :
+		return ', '.join(f"{strand_name} 5':{depths[0]}" for strand_name, depths in zip(DamageStats.strand_names, edge_count))
+	return ', '.join(f"{strand_name} 5':{depths[0]} 3':{depths[1]}" for strand_name, depths in zip(DamageStats.strand_names, edge_count))
+
+# Profile category of a read base by strand, reference base and read base (flattened, index strand << 16 | reference << 8 | read):
+# 1 a reference C (of the molecule), 2 a C>T, 3 a reference G, 4 a G>A and 0 anything else. Reverse reads are stored reverse
+# complemented, so their reference G is a C of the molecule and a G>A in the read is a C>T
+def profile_categories() :
+	categories = np.zeros((2, 256, 256), dtype=np.uint8)
+	for strand, (base_C, base_T, base_G, base_A) in enumerate([(BASE_C, BASE_T, BASE_G, BASE_A), (BASE_G, BASE_A, BASE_C, BASE_T)]) :
+		categories[strand, base_C, :] = 1
+		categories[strand, base_C, base_T] = 2
+		categories[strand, base_G, :] = 3
+		categories[strand, base_G, base_A] = 4
+	return categories.reshape(-1)
+
+PROFILE_CATEGORY = profile_categories()
+
+# Damage statistics for reference guided masking, collected in the same pass as the masking itself.
+# The histograms count reads by their number of damaged bases, indels, other mismatches and the total of these, for forward
+# and reverse reads separately. They start with room for 64 events per read and grow whenever a read doesn't fit, so nothing is capped.
+# The positional profiles count C>T and G>A (and the reference Cs and Gs they are measured against) along the first and last
+# profile_length bases of the molecules, split by strand and read length bin. Reverse reads are read backwards and complemented,
+# so position 0 of the 5' end is always the first base of the original molecule (the "smiley plot" of DamageProfiler/mapDamage)
+class DamageStats :
+
+	hist_names = ['dmg', 'indels', 'other_mismatches', 'mismatches_total']
+	profile_names = ['C>T', 'C', 'G>A', 'G']
+	strand_names = ['fwd', 'rev']
+	end_names = ["5'", "3'"]
+	length_bins = [0, 30, 40, 50, 60, 70, 80, 90, 100, 150] # Lower edges, the last bin holds all reads of 150 bp and longer
+
+	def __init__(self, profile_length=25) :
+		self.total = 0 # Number of processed reads (also outside of reference guidance)
+		self.profile_length = profile_length
+		self.hists = np.zeros((len(self.hist_names), 2, 64), dtype=np.int64) # kind, strand, events per read
+		self.profile = np.zeros((len(self.profile_names), 2, len(self.length_bins), 2, profile_length), dtype=np.int64) # kind, strand, length bin, end, position
+
+	# Make room in the histograms for reads with up to size-1 events
+	def grow(self, size) :
+		if size > self.hists.shape[2] :
+			self.hists = np.pad(self.hists, ((0, 0), (0, 0), (0, max(size, 2*self.hists.shape[2]) - self.hists.shape[2])))
+
+	# Add the per-read event counts of a batch to a histogram
+	def add_histogram(self, kind, counts, is_reverse) :
+		if len(counts) == 0 :
+			return
+		size = int(counts.max()) + 1
+		self.grow(size)
+		for strand, strand_reads in enumerate([~is_reverse, is_reverse]) :
+			self.hists[kind, strand, :size] += np.bincount(counts[strand_reads], minlength=size)
+
+	# Add the C>T and G>A counts along the molecule ends of a batch (reference guided batches only). Only the first and last
+	# profile_length bases of every read are looked at, the first bases are the 5' end of a forward molecule and the 3' end
+	# of a reverse one, the last bases the other end (reads shorter than the profile are counted at both ends).
+	# Every base gets its profile category (see PROFILE_CATEGORY), so the whole batch is counted with a single bincount
+	def add_profile(self, batch) :
+		window = np.minimum(batch.lengths, self.profile_length)
+		read_index = np.repeat(np.arange(len(window)), window)
+		window_pos = np.arange(len(read_index)) - np.repeat(np.cumsum(window) - window, window)
+		length_bin = np.searchsorted(self.length_bins, batch.lengths, side='right') - 1
+		end_index = (batch.is_reverse * len(self.length_bins) + length_bin) * 2 # Profile index of the 5' end of every read, without the position
+		strand = batch.is_reverse.astype(np.intp)[read_index] << 16
+		keys = []
+		for starts, read_end, first_pos, pos_step in [(batch.offsets[:-1], batch.is_reverse, 0, 1), (batch.offsets[1:] - window, ~batch.is_reverse, window - 1, -1)] :
+			index = starts[read_index] + window_pos
+			category = PROFILE_CATEGORY[strand | (batch.ref_buf[index].astype(np.intp) << 8) | batch.seq_buf[index]]
+			profile_index = ((end_index + read_end) * self.profile_length + first_pos)[read_index] + pos_step * window_pos
+			keys.append(profile_index * 5 + category)
+		counts = np.bincount(np.concatenate(keys), minlength=self.profile[0].size * 5).reshape(-1, 5)
+		for kind, categories in enumerate([[2], [1, 2], [4], [3, 4]]) :
+			self.profile[kind] += counts[:, categories].sum(axis=1).reshape(self.profile.shape[1:])
+
+	# Add the statistics of another DamageStats object (e.g. from a worker process) to this one
+	def merge(self, other) :
+		self.total += other.total
+		self.grow(other.hists.shape[2])
+		self.hists[:, :, :other.hists.shape[2]] += other.hists
+		self.profile += other.profile
+
+	# The counts as plain lists, to store them in a checkpoint (see Checkpoint), and back
+	def state(self) :
+		return {'total': self.total, 'hists': self.hists.tolist(), 'profile': self.profile.tolist()}
+
+	def load_state(self, state) :
+		self.total = state['total']
+		self.hists = np.array(state['hists'], dtype=np.int64)
+		self.profile = np.array(state['profile'], dtype=np.int64)
+
+	# Highest number of events any read had, over all histograms
+	def max_events(self) :
+		events = np.flatnonzero(self.hists.sum(axis=(0, 1)))
+		return int(events[-1]) if len(events) else 0
+
+	def length_bin_names(self) :
+		edges = self.length_bins
+		return [f"{edges[i]}-{edges[i+1]-1}" for i in range(len(edges)-1)] + [f"{edges[-1]}+"]
+
+	# Output the stats tsv file containing the "edit distance" per read (one row per number of mismatches, at least 0-9)
+	def write_tsv(self, file_name, input_file) :
+		self.grow(max(10, self.max_events()+1))
+		with open(file_name, "a") as o:
+			print(f"Analysis for {input_file}, total reads analyzed: {self.total}\n", file=o, end="")
+			print(f"Mismatches\tfwd_reads_dmg\tfwd_reads_indels\tfwd_reads_other_mismatches\tfwd_reads_mismatches_total\t", file=o, end="")
+			print(f"rev_reads_dmg\trev_reads_indels\trev_reads_other_mismatches\trev_reads_mismatches_total\t", file=o, end="")
+			print(f"tot_reads_dmg\ttot_reads_indels\ttot_reads_other_mismatches\ttot_reads_mismatches_total", file=o)
+			for i in range(0, max(10, self.max_events()+1)) :
+				fwd = self.hists[:, 0, i]
+				rev = self.hists[:, 1, i]
+				print('\t'.join(str(count) for count in [i] + fwd.tolist() + rev.tolist() + (fwd+rev).tolist()), file=o)
+
+	# Output the positional damage profile, the C>T and G>A frequencies per position from the 5' and 3' end,
+	# for every strand and length bin, plus all length bins combined ('all')
+	def write_profile_tsv(self, file_name) :
+		bin_names = self.length_bin_names()
+		with open(file_name, "w") as o:
+			print("strand\tlength_bin\tend\tposition\tC>T\tC\tC>T_freq\tG>A\tG\tG>A_freq", file=o)
+			for strand, strand_name in enumerate(self.strand_names) :
+				for length_bin, bin_name in list(enumerate(bin_names)) + [(None, 'all')] :
+					counts = self.profile[:, strand].sum(axis=1) if length_bin is None else self.profile[:, strand, length_bin]
+					for end, end_name in enumerate(self.end_names) :
+						for pos in range(self.profile_length) :
+							CT, C, GA, G = counts[:, end, pos].tolist()
+							print(f"{strand_name}\t{bin_name}\t{end_name}\t{pos}\t{CT}\t{C}\t{CT/C if C else 0:.6f}\t{GA}\t{G}\t{GA/G if G else 0:.6f}", file=o)
+
+	# The C>T frequency of the first base (5') and the G>A frequency of the last base (3') of the molecules, over all strands and lengths
+	def terminal_damage(self) :
+		CT, C, GA, G = self.profile[:, :, :, :, 0].sum(axis=(1, 2)).tolist()
+		return CT[0]/C[0] if C[0] else 0, GA[1]/G[1] if G[1] else 0
+
+	# Output the histograms and the profile counts as json, for plotting or for combining runs
+	def write_json(self, file_name, input_file) :
+		max_events = self.max_events() + 1
+		report = {
+			'input_file': input_file,
+			'total_reads': self.total,
+			'histograms': {strand_name: {hist_name: self.hists[kind, strand, :max_events].tolist() for kind, hist_name in enumerate(self.hist_names)} for strand, strand_name in enumerate(self.strand_names)},
+			'profile': {
+				'dimensions': ['strand', 'length_bin', 'end', 'position'],
+				'strands': self.strand_names,
+				'length_bins': self.length_bin_names(),
+				'ends': self.end_names,
+				'counts': {profile_name: self.profile[kind].tolist() for kind, profile_name in enumerate(self.profile_names)},
+			},
+		}
+		with open(file_name, "w") as o:
+			json.dump(report, o)
+
+# Pick the edge masking depth from a damage profile, for both strands: the C>T depth of the 5' end and the G>A depth of the 3' end is the
+# first position where the damage frequency is less than threshold above the background, the frequency in the second half of the profile.
+# A strand or end without at least min_bases reference bases on its first position keeps the depth of edge_count.
+# Returns the depth per strand and end (see edge_counts), and the damage frequencies of the first position and the background
+def calibrate_edge_count(stats, edge_count, threshold=0.01, min_bases=500) :
+	depths = edge_counts(edge_count)
+	depths = [list(strand_depths) for strand_depths in depths]
+	counts = stats.profile.sum(axis=2) # kind, strand, end, position
+	background_start = stats.profile_length // 2
+	frequencies = [[None, None], [None, None]]
+	for strand in range(2) :
+		for end, (damage, bases) in enumerate([(counts[0, strand, 0], counts[1, strand, 0]), (counts[2, strand, 1], counts[3, strand, 1])]) :
+			if bases[0] < min_bases :
+				continue
+			background = damage[background_start:].sum() / max(bases[background_start:].sum(), 1)
+			excess = damage[:background_start] / np.maximum(bases[:background_start], 1) - background
+			below = np.flatnonzero(excess < threshold)
+			depths[strand][end] = int(below[0]) if len(below) else background_start
+			frequencies[strand][end] = (float(damage[0] / bases[0]), float(background))
+	return depths, frequencies
+
+# Run metrics of the masking hot path, counting what happened to the reads (and why they were filtered out),
+# how many bases were masked per masking mode, and the time spent in every stage of the pipeline.
+# With a progress interval (in seconds) it prints the throughput every time that interval has passed
+class RunMetrics :
+
+	count_names = ['seen', 'unmapped', 'low_mapq', 'too_short', 'off_site', 'masked', 'written', 'filtered_kept']
+	stage_names = ['calibration', 'decoding', 'sites', 'reference', 'cigar', 'masking', 'tags', 'writing']
+
+	def __init__(self, progress_interval=0) :
+		self.counts = dict.fromkeys(self.count_names, 0)
+		self.bases_masked = {} # Masking mode, number of bases masked
+		self.stage_time = dict.fromkeys(self.stage_names, 0.0)
+		self.progress_interval = progress_interval
+		self.start_time = time.perf_counter()
+		self.last_report = self.start_time
+
+	# Add the time since start to a stage, and return the current time so the next stage can start from there
+	def add_stage_time(self, stage, start) :
+		now = time.perf_counter()
+		self.stage_time[stage] += now - start
+		return now
+
+	def add_masked(self, mode_name, reads, bases) :
+		self.counts['masked'] += reads
+		self.bases_masked[mode_name] = self.bases_masked.get(mode_name, 0) + bases
+
+	# Add the metrics of another RunMetrics object (e.g. from a worker process) to this one, stage times are summed
+	# over the workers, so in a multi-process run they add up to more than the elapsed time
+	def merge(self, other) :
+		for name, count in other.counts.items() :
+			self.counts[name] += count
+		for mode_name, bases in other.bases_masked.items() :
+			self.bases_masked[mode_name] = self.bases_masked.get(mode_name, 0) + bases
+		for stage, seconds in other.stage_time.items() :
+			self.stage_time[stage] += seconds
+
+	def elapsed(self) :
+		return time.perf_counter() - self.start_time
+
+	# The metrics as plain values, to store them in a checkpoint (see Checkpoint), and back. The elapsed time carries over as well
+	def state(self) :
+		return {'counts': self.counts, 'bases_masked': self.bases_masked, 'stage_time': self.stage_time, 'elapsed': self.elapsed()}
+
+	def load_state(self, state) :
+		self.counts.update(state['counts'])
+		self.bases_masked = dict(state['bases_masked'])
+		self.stage_time.update(state['stage_time'])
+		self.start_time = time.perf_counter() - state['elapsed']
+
+	def report_progress(self, force=False) :
+		if not self.progress_interval :
+			return
+		now = time.perf_counter()
+		if force or now - self.last_report >= self.progress_interval :
+			self.last_report = now
+			elapsed = now - self.start_time
+			print(f"Progress: {self.counts['seen']:,} reads seen, {self.counts['written']:,} written, {self.counts['masked']:,} masked ({self.counts['seen']/elapsed if elapsed else 0:,.0f} reads/s, {elapsed:.1f} s elapsed)", file=sys.stderr, flush=True)
+
+	def summary(self) :
+		elapsed = self.elapsed()
+		return {
+			'elapsed_seconds': round(elapsed, 3),
+			'reads_per_second': round(self.counts['seen']/elapsed, 1) if elapsed else 0,
+			'reads': dict(self.counts),
+			'bases_masked': dict(self.bases_masked),
+			'stage_seconds': {stage: round(seconds, 3) for stage, seconds in self.stage_time.items()},
+		}
+
+	def print_summary(self) :
+		summary = self.summary()
+		print(f"Reads seen: {self.counts['seen']:,} (filtered out: {self.counts['unmapped']:,} unmapped, {self.counts['low_mapq']:,} below MapQ cutoff, {self.counts['too_short']:,} below length cutoff)")
+		print(f"Reads written: {self.counts['written']:,}, of which masked: {self.counts['masked']:,}")
+		if self.counts['filtered_kept'] :
+			print(f"Filtered out reads passed through unmasked: {self.counts['filtered_kept']:,}")
+		if self.counts['off_site'] :
+			print(f"Reads without any panel site (left untouched): {self.counts['off_site']:,}")
+		for mode_name, bases in self.bases_masked.items() :
+			print(f"Bases masked ({mode_name}): {bases:,}")
+		print(f"Throughput: {summary['reads_per_second']:,.0f} reads/s over {summary['elapsed_seconds']:.1f} s")
+		print("Time per stage: " + ', '.join(f"{stage} {seconds:.2f} s" for stage, seconds in self.stage_time.items()))
+
+	def write_json(self, file_name, input_file) :
+		report = {'input_file': input_file}
+		report.update(self.summary())
+		with open(file_name, "w") as o:
+			json.dump(report, o, indent=1)
+
+# Edit distance scoring for reference guided masking. Damage is counted as if the whole read was hard masked
+# (including Ns already in the read), indels are the inserted and deleted bases from the CIGAR, and other mismatches
+# are all aligned read bases that differ from the reference
+def score_batch(batch, strandness, calc_indel, stats) :
+	seq_buf = batch.seq_buf
+	calc_dmg = batch.read_sums(damage_mask(batch, "H", 0, strandness) | (seq_buf == BASE_N))
+	calc_MM = batch.read_sums((batch.ref_buf != seq_buf) & (seq_buf != BASE_N) & (batch.ref_buf != BASE_GAP))
+	num_total = calc_dmg + calc_indel + calc_MM
+	for kind, counts in enumerate([calc_dmg, calc_indel, calc_MM, num_total]) :
+		stats.add_histogram(kind, counts, batch.is_reverse)
+	stats.add_profile(batch)
+
+# CIGAR operations that consume read bases (match, insertion, soft clip, sequence match and mismatch), that consume reference
+# bases (match, deletion, skipped region, sequence match and mismatch), that line read and reference up, and that are indels.
+# Hard clips (5) and padding (6) are neither in the read nor in the reference window
+CIGAR_READ = np.array([1, 1, 0, 0, 1, 0, 0, 1, 1, 0], dtype=bool)
+CIGAR_REF = np.array([1, 0, 1, 1, 0, 0, 0, 1, 1, 0], dtype=bool)
+CIGAR_ALIGNED = np.array([1, 0, 0, 0, 0, 0, 0, 1, 1, 0], dtype=bool)
+CIGAR_INDEL = np.array([0, 1, 1, 0, 0, 0, 0, 0, 0, 0], dtype=bool)
+
+# Line up the reference windows of a batch of reads with the read bases, for all CIGAR operations of the batch at once (no gapped strings are built).
+# Returns the reference base for every read base of the packed batch (a gap where the read base has no reference base, i.e. insertions,
+# soft clips and reads without a CIGAR), the number of inserted and deleted bases per read, and the reads whose CIGAR doesn't
+# line up with their read or reference window (in which case there is no reference buffer)
+def align_batch_to_reference(packed, cigars, ref_windows) :
+	aligned_reads = [i for i, cigar in enumerate(cigars) if cigar]
+	windows = [ref_windows[i] for i in aligned_reads]
+	op_counts = np.zeros(len(cigars), dtype=np.int64)
+	op_counts[aligned_reads] = np.fromiter(map(len, filter(None, cigars)), dtype=np.int64, count=len(aligned_reads))
+	operations = np.fromiter(itertools.chain.from_iterable(itertools.chain.from_iterable(filter(None, cigars))), dtype=np.int64, count=2*int(op_counts.sum())).reshape(-1, 2)
+	operation, length = operations[:, 0], operations[:, 1]
+	op_read = np.repeat(np.arange(len(cigars)), op_counts)
+	window_lengths = np.zeros(len(cigars), dtype=np.int64)
+	window_lengths[aligned_reads] = np.fromiter(map(len, windows), dtype=np.int64, count=len(windows))
+	# Offset of every operation within the read and within the reference window of its read
+	op_positions = []
+	for consumes, lengths in [(CIGAR_READ, packed.lengths), (CIGAR_REF, window_lengths)] :
+		op_length = np.where(consumes[operation], length, 0)
+		op_end = np.cumsum(op_length)
+		spans = np.bincount(op_read, op_length, minlength=len(cigars)).astype(np.int64)
+		misaligned = np.flatnonzero((op_counts > 0) & (spans != lengths))
+		if len(misaligned) :
+			return None, None, misaligned
+		op_positions.append(op_end - op_length - (np.cumsum(spans) - spans)[op_read])
+	read_pos, ref_pos = op_positions
+	window_offsets = np.cumsum(window_lengths) - window_lengths
+	aligned = CIGAR_ALIGNED[operation]
+	windows_buf = np.frombuffer(b''.join(windows), dtype=np.uint8)
+	ref_buf = np.full(len(packed.seq_buf), BASE_GAP, dtype=np.uint8)
+	ref_buf[window_index(packed.offsets[op_read[aligned]] + read_pos[aligned], length[aligned])] = windows_buf[window_index(window_offsets[op_read[aligned]] + ref_pos[aligned], length[aligned])]
+	calc_indel = np.bincount(op_read, np.where(CIGAR_INDEL[operation], length, 0), minlength=len(cigars)).astype(np.int64)
+	return ref_buf, calc_indel, misaligned
+
+# Set the masked sequences (masked bases swapped for N) of the reads with masked bases, the base qualities are put back after
+# the new sequence is set (pysam clears them whenever a sequence is assigned). Reads without masked bases aren't touched at all,
+# so they are written out as they were read, without encoding their sequence again
+def set_masked_seqs(batch, packed, mask, masked_counts) :
+	masked_reads = np.flatnonzero(masked_counts).tolist()
+	if not masked_reads :
+		return
+	masked_seqs = packed.masked_seqs(mask)
+	offsets = packed.offsets.tolist()
+	for i in masked_reads :
+		read = batch[i]
+		read_qualities = read.query_qualities # Obtain the original quality values
+		read.query_sequence = masked_seqs[offsets[i]:offsets[i+1]] # Update the sequence field
+		read.query_qualities = read_qualities # Preserve the original quality values
+
+# Soft masking, set the base quality of masked bases to mask_quality, leaving the sequence as it is.
+# Only reads with masked bases are touched, their quality array is edited in place through a numpy view.
+# Reads without base qualities can't be soft masked, so those are masked with Ns instead
+def set_masked_qualities(batch, packed, mask, masked_counts, mask_quality) :
+	offsets = packed.offsets.tolist()
+	for i, masked in enumerate(masked_counts.tolist()) :
+		if masked :
+			read = batch[i]
+			read_mask = mask[offsets[i]:offsets[i+1]]
+			read_qualities = read.query_qualities
+			if read_qualities is None :
+				read.query_sequence = ''.join(['N' if masked else base for masked, base in zip(read_mask, read.query_sequence)])
+			else :
+				np.frombuffer(read_qualities, dtype=np.uint8)[read_mask] = mask_quality
+				read.query_qualities = read_qualities
+
+# Recompute the MD and NM tags of a reference guided batch after masking, the same way samtools calmd does: every aligned read base
+# that differs from the reference, and every N, is a mismatch. NM is the number of mismatches plus the inserted and deleted bases.
+# seq_buf holds the read bases as they are written out, ref_windows the (unaligned) reference window of every read
+def set_alignment_tags(batch, packed, seq_buf, ref_windows, calc_indel) :
+	mismatch = ((seq_buf != packed.ref_buf) | (seq_buf == BASE_N)) & (packed.ref_buf != BASE_GAP)
+	edit_distance = (packed.read_sums(mismatch) + calc_indel).tolist()
+	mismatch_pos = np.flatnonzero(mismatch)
+	bounds = np.searchsorted(mismatch_pos, packed.offsets).tolist()
+	offsets = packed.offsets.tolist()
+	mismatch_pos = mismatch_pos.tolist()
+	for i, read in enumerate(batch) :
+		if ref_windows[i] is None : # Mapped without an alignment, there are no tags to compute
+			continue
+		read_mismatches = [pos - offsets[i] for pos in mismatch_pos[bounds[i]:bounds[i+1]]]
+		read.set_tag('MD', md_tag(read.cigartuples, ref_windows[i], read_mismatches), 'Z')
+		read.set_tag('NM', edit_distance[i], 'i')
+
+# Build the MD tag of a read from its CIGAR, its reference window and the (sorted) read offsets of its mismatches.
+# Matching bases are counted, mismatches add the reference base and deletions add '^' plus the deleted reference bases
+def md_tag(cigartuples, reference_seq, mismatches) :
+	md = []
+	match_count = 0
+	ref_pos = 0
+	read_pos = 0
+	next_mismatch = 0
+	for operation, length in cigartuples :
+		if operation == 0 or operation == 7 or operation == 8 :
+			block_end = read_pos + length
+			while next_mismatch < len(mismatches) and mismatches[next_mismatch] < block_end :
+				offset = mismatches[next_mismatch]
+				match_count += offset - read_pos
+				ref_pos += offset - read_pos
+				md.append(f"{match_count}{chr(reference_seq[ref_pos])}")
+				ref_pos += 1
+				read_pos = offset + 1
+				match_count = 0
+				next_mismatch += 1
+			match_count += block_end - read_pos
+			ref_pos += block_end - read_pos
+			read_pos = block_end
+		elif operation == 1 or operation == 4 :
+			read_pos += length
+		elif operation == 2 :
+			md.append(f"{match_count}^{bytes(reference_seq[ref_pos:ref_pos+length]).decode()}")
+			match_count = 0
+			ref_pos += length
+		elif operation == 3 :
+			ref_pos += length
+	md.append(str(match_count))
+	return ''.join(md)
+
+# A configured masker, holding the settings of a run together with its own reference, damage statistics (stats) and run metrics (metrics),
+# so several maskers (e.g. one per sample) can be used next to each other within one process, or embedded in another pysam based script.
+# Reads can be masked one at a time (mask_read), per batch (mask_batch), as a stream (mask_reads) or a whole SAM/BAM file at once (mask_file).
+# Reads are masked in place, reads that don't pass the filters are left out. Problems are raised as a DamageMaskerError.
+# read_groups maps read group IDs or libraries (LB) to their own masking, edge_count and/or strandness (see read_rg_config),
+# the reads of those read groups are then masked with these settings instead, in the same pass.
+# sorted_input tells the reference how reads given to mask_read, mask_batch and mask_reads arrive, set it to False for reads that
+# are not coordinate sorted (mask_file takes the sort order from the header of each file instead)
+class Masker :
+
+	def __init__(self, *, masking="H", edge_count=5, strandness="S", ref_file="NA", mapq_cutoff=0, len_cutoff=0, soft_mask=False, mask_quality=0, ref_cache_mb=1024, profile_length=25, progress_interval=0, sites_file=None, reference=None, update_tags=False, strip_tags=(), read_groups=None, sorted_input=True) :
+		# The settings as given, to set up identical maskers in the worker processes
+		self.settings = {'masking':masking, 'edge_count':edge_count, 'strandness':strandness, 'ref_file':ref_file, 'mapq_cutoff':mapq_cutoff, 'len_cutoff':len_cutoff,
+			'soft_mask':soft_mask, 'mask_quality':mask_quality, 'ref_cache_mb':ref_cache_mb, 'profile_length':profile_length, 'sites_file':sites_file,
+			'update_tags':update_tags, 'strip_tags':strip_tags, 'read_groups':read_groups, 'sorted_input':sorted_input}
+		masking = masking.upper()
+		strandness = strandness.upper()
+		if not masking in ["H", "E", "F", "S"] :
+			raise DamageMaskerError(f"The masking setting '{masking}' is not recognized. Please use \'S\' for SoftMasking, \'H\' for HardMasking, \'E\' for EdgeMasking and \'F\' for Filtering.")
+		if not strandness in ["S", "D"] :
+			raise DamageMaskerError(f"User input for strandness '{strandness}' is not recognized.\nOnly \'S\'and \'D\' are recognized as valid library types at this point.")
+		if not 0 <= mask_quality <= 93 :
+			raise DamageMaskerError("--mask_quality needs to be a base quality between 0 and 93.")
+		if profile_length < 1 :
+			raise DamageMaskerError("--profile_length needs to be at least 1.")
+		if not ref_file == "NA" and not os.path.exists(ref_file) :
+			raise DamageMaskerError(f"Input reference FASTA file '{ref_file}' not found.")
+		if update_tags and ref_file == "NA" :
+			raise DamageMaskerError("Recomputing the MD and NM tags (--calmd) requires reference guidance, please give the reference with --ref_file.")
+		if any(not len(tag) == 2 for tag in strip_tags) :
+			raise DamageMaskerError(f"The tags to strip ({','.join(strip_tags)}) need to be two character SAM tags, e.g. BQ,OQ.")
+		if masking == "S" : # SoftMasking picks the same bases as HardMasking, but lowers their base quality instead of replacing them
+			masking = "H"
+			soft_mask = True
+
+		self.masking = masking
+		self.edge_count = edge_count
+		self.strandness = strandness
+		self.ref_file = ref_file
+		self.mapq_cutoff = mapq_cutoff
+		self.len_cutoff = len_cutoff
+		self.soft_mask = soft_mask
+		self.mask_quality = mask_quality
+		self.ref_cache_mb = ref_cache_mb
+		self.sorted_input = sorted_input
+		self.update_tags = update_tags # Recompute MD and NM of the masked reads in the same pass
+		self.strip_tags = list(strip_tags) # Tags removed from every read that is written
+		self.mode_name = f"{'quality' if soft_mask else 'N'}_{'edge' if masking == 'E' else 'hard'}{'' if ref_file == 'NA' else '_ref'}{'' if sites_file is None else '_sites'}"
+		# Only bases on the sites of a target panel are masked, reads without any site are left as they are
+		self.sites = SiteIndex(sites_file) if sites_file is not None else None
+		# A reference can be handed in to share it between several maskers, it's then left open when the masker is closed
+		self.reference = reference
+		self.shared_reference = reference is not None
+		self.stats = DamageStats(profile_length)
+		self.metrics = RunMetrics(progress_interval)
+
+		# Read group profiles, every profile gets a masker of its own that only masks (filtering, the reference and the sites
+		# stay with this masker). Reads are dispatched on their RG tag through group_dispatch, a single dict lookup per read,
+		# reads of other read groups (or without an RG tag) go to default_group, which has the settings of this masker
+		self.group_maskers = OrderedDict()
+		for profile, overrides in (read_groups or {}).items() :
+			group_settings = dict(self.settings, sites_file=None, read_groups=None)
+			group_settings.update(overrides)
+			group = Masker(**group_settings, reference=self.reference)
+			group.sites = self.sites
+			if self.sites is not None :
+				group.mode_name += '_sites'
+			self.group_maskers[profile] = group
+		self.default_group = None
+		self.group_dispatch = {}
+		if self.group_maskers :
+			self.default_group = Masker(**dict(self.settings, sites_file=None, read_groups=None), reference=self.reference)
+			self.default_group.sites = self.sites
+			self.default_group.mode_name = self.mode_name
+			self.group_dispatch = {profile: (profile, group) for profile, group in self.group_maskers.items()} # Until set_read_groups sees a header, profiles match RG IDs only
+		self.read_group_libraries = OrderedDict() # RG ID, library of the @RG lines of the header
+		self.read_group_stats = {} # RG ID (None for reads without an RG tag), [profile, DamageStats, RunMetrics] of the reads of that read group
+
+	def __enter__(self) :
+		return self
+
+	def __exit__(self, *exc_info) :
+		self.close()
+
+	def close(self) :
+		if self.reference is not None and not self.shared_reference :
+			self.reference.close()
+		self.reference = None
+
+	# Load the reference genome (once), coordinate sorted input lets the cache stream through it contig by contig.
+	# An open (or shared) reference only switches to the access mode of the given sort order (by default that of the masker)
+	def open_reference(self, sorted_input=None) :
+		if sorted_input is None :
+			sorted_input = self.sorted_input
+		if self.ref_file == "NA" :
+			return
+		if self.reference is None :
+			self.reference = open_reference_file(self.ref_file, sorted_input, self.ref_cache_mb)
+		else :
+			self.reference.set_sorted(sorted_input)
+
+	# Compile the read group dispatch table from the @RG lines of a SAM/BAM header. A profile matches a read group by its ID,
+	# or otherwise by its library (LB). Returns the profiles that didn't match any read group of the header
+	def set_read_groups(self, header) :
+		if not self.group_maskers :
+			return []
+		dispatch = {profile: (profile, group) for profile, group in self.group_maskers.items()}
+		self.read_group_libraries = OrderedDict()
+		matched = set()
+		for read_group in header.to_dict().get('RG', []) :
+			self.read_group_libraries[read_group['ID']] = read_group.get('LB')
+			for profile in [read_group['ID'], read_group.get('LB')] :
+				if profile in self.group_maskers :
+					dispatch[read_group['ID']] = (profile, self.group_maskers[profile])
+					matched.add(profile)
+					break
+		self.group_dispatch = dispatch
+		return [profile for profile in self.group_maskers if not profile in matched]
+
+	# Yield the reads that pass the filters
+	def filter_reads(self, reads) :
+		for batch, passed in self.read_batches(reads) :
+			yield from passed
+
+	# Group the reads into batches of (up to) BATCH_SIZE reads to write, yields (batch, passed) pairs, where passed are the reads of the
+	# batch that passed the filters (the ones to mask). Filtered out reads are dropped, or passed through unmasked: kept in the batch
+	# in their own place (keep_filtered), or written to filtered_file right away
+	# The reads that don't pass the filters are counted per reason. The tags of strip_tags are removed from every read, so also from
+	# filtered out reads that are passed through
+	def read_batches(self, reads, keep_filtered=False, filtered_file=None) :
+		counts = self.metrics.counts
+		strip_tags = self.strip_tags
+		mapq_cutoff = self.mapq_cutoff
+		len_cutoff = self.len_cutoff
+		batch = []
+		passed = [] if keep_filtered else batch
+		for read in reads :
+			counts['seen'] += 1
+			for tag in strip_tags :
+				read.set_tag(tag, None)
+			if read.is_unmapped :
+				filtered = 'unmapped'
+			elif read.mapping_quality < mapq_cutoff :
+				filtered = 'low_mapq'
+			elif read.query_length < len_cutoff :
+				filtered = 'too_short'
+			else :
+				filtered = None
+			if filtered is None :
+				self.stats.total += 1 # Just counting the number of processed reads
+				passed.append(read)
+				if keep_filtered :
+					batch.append(read)
+			else :
+				counts[filtered] += 1
+				if keep_filtered :
+					batch.append(read)
+					counts['filtered_kept'] += 1
+				elif filtered_file is not None :
+					filtered_file.write(read)
+					counts['filtered_kept'] += 1
+			if len(batch) == BATCH_SIZE :
+				yield batch, passed
+				batch = []
+				passed = [] if keep_filtered else batch
+		if batch :
+			yield batch, passed
+
+	# Mask a single read, returns the masked read, or None if it didn't pass the filters. Masking reads one by one is a lot
+	# slower than masking them in batches, so use mask_batch or mask_reads for more than a handful of reads
+	def mask_read(self, read) :
+		batch = self.mask_batch([read])
+		return batch[0] if batch else None
+
+	# Mask a batch of reads, returns a list of the reads that passed the filters (masked)
+	def mask_batch(self, reads) :
+		batch = list(self.filter_reads(reads))
+		if batch :
+			self.mask_filtered(batch)
+		return batch
+
+	# Mask a stream of reads, BATCH_SIZE reads at a time, and yield the reads that passed the filters (masked) in the order they came in
+	def mask_reads(self, reads) :
+		batch = []
+		for read in self.filter_reads(reads) :
+			batch.append(read)
+			if len(batch) == BATCH_SIZE :
+				self.mask_filtered(batch)
+				yield from batch
+				batch = []
+		if batch :
+			self.mask_filtered(batch)
+			yield from batch
+
+	# Mask a batch of reads that passed the filters
+	def mask_filtered(self, batch) :
+
+		if self.group_maskers :
+			self.mask_read_groups(batch)
+			return
+		if self.masking == "F" : # If masking is F it won't need to do anything, filtering already happend upstream of the function
+			return
+
+		metrics = self.metrics
+		if self.reference is None :
+			self.open_reference()
+		if self.sites is not None :
+			stage_start = time.perf_counter()
+			site_offsets = self.sites.batch_offsets(batch)
+			on_site = [read_offsets for read_offsets in site_offsets if read_offsets]
+			metrics.counts['off_site'] += len(batch) - len(on_site)
+			if len(on_site) < len(batch) :
+				batch = [read for read, read_offsets in zip(batch, site_offsets) if read_offsets]
+			site_offsets = on_site
+			metrics.add_stage_time('sites', stage_start)
+			if not batch :
+				return
+		is_reverse = np.fromiter(map(attrgetter('is_reverse'), batch), dtype=bool, count=len(batch))
+		read_seqs = list(map(attrgetter('query_sequence'), batch))
+
+		if not self.ref_file =="NA" :
+			packed = PackedBatch(read_seqs, is_reverse)
+			packed.ref_buf, ref_windows, calc_indel = self.reference_batch(batch, packed, metrics)
+			stage_start = time.perf_counter()
+			score_batch(packed, self.strandness, calc_indel, self.stats)
+
+		elif self.masking == "H" and not self.soft_mask and self.sites is None : # Hard Masking, a translate of the whole batch for each strand, every read then takes its own strand
+			stage_start = time.perf_counter()
+			joined_seqs = ''.join(read_seqs)
+			if self.strandness == "D" :
+				fwd_seqs = rev_seqs = joined_seqs.translate(HARD_MASK_AT)
+				masked_bases = joined_seqs.count('A') + joined_seqs.count('T')
+			else :
+				fwd_seqs = joined_seqs.translate(HARD_MASK_T)
+				rev_seqs = joined_seqs.translate(HARD_MASK_A)
+				masked_bases = ''.join([read_sequence for read_sequence, reverse in zip(read_seqs, is_reverse.tolist()) if not reverse]).count('T')
+				masked_bases += ''.join([read_sequence for read_sequence, reverse in zip(read_seqs, is_reverse.tolist()) if reverse]).count('A')
+			masked_reads = 0
+			start = 0
+			for read, read_sequence in zip(batch, read_seqs) :
+				end = start + len(read_sequence)
+				modified_sequence = (rev_seqs if read.is_reverse else fwd_seqs)[start:end]
+				start = end
+				if not modified_sequence == read_sequence :
+					masked_reads += 1
+					read_qualities = read.query_qualities
+					read.query_sequence = modified_sequence
+					read.query_qualities = read_qualities
+			metrics.add_masked(self.mode_name, masked_reads, masked_bases)
+			metrics.add_stage_time('masking', stage_start)
+			return
+
+		else :
+			stage_start = time.perf_counter()
+			packed = PackedBatch(read_seqs, is_reverse)
+
+		mask = damage_mask(packed, self.masking, self.edge_count, self.strandness)
+		if self.sites is not None :
+			site_mask = np.zeros(len(mask), dtype=bool)
+			site_mask[[start + offset for start, read_offsets in zip(packed.offsets.tolist(), site_offsets) for offset in read_offsets]] = True
+			mask &= site_mask
+		masked_counts = packed.index_counts(np.flatnonzero(mask)) if self.masking == "E" else packed.read_sums(mask) # Edge masking only masks a few bases per read
+		metrics.add_masked(self.mode_name, int(np.count_nonzero(masked_counts)), int(masked_counts.sum()))
+		if self.soft_mask :
+			set_masked_qualities(batch, packed, mask, masked_counts, self.mask_quality)
+		else :
+			set_masked_seqs(batch, packed, mask, masked_counts)
+		stage_start = metrics.add_stage_time('masking', stage_start)
+
+		if self.update_tags :
+			if self.soft_mask : # Only reads without base qualities got Ns
+				no_qualities = np.fromiter((read.query_qualities is None for read in batch), dtype=bool, count=len(batch))
+				mask = mask & no_qualities[packed.read_index]
+			set_alignment_tags(batch, packed, np.where(mask, BASE_N, packed.seq_buf), ref_windows, calc_indel)
+			metrics.add_stage_time('tags', stage_start)
+
+	# Fetch the reference of every read of a packed batch and line it up with the read through its CIGAR. Returns the reference base of every read base
+	# (a gap for inserted and clipped bases, all gaps for a read without an alignment), the fetched reference windows and the indel bases per read
+	def reference_batch(self, batch, packed, metrics) :
+		# Load the reference sequences
+		# (every contig of the batch is looked up once, reads on a contig that is kept in memory are then just a slice of it)
+		stage_start = time.perf_counter()
+		cigars = list(map(attrgetter('cigartuples'), batch))
+		reference_ids = list(map(attrgetter('reference_id'), batch))
+		ref_windows = []
+		try:
+			contigs = {}
+			for reference_id in set(reference_ids) :
+				contig = batch[0].header.get_reference_name(reference_id)
+				contigs[reference_id] = (contig, self.reference.contig(contig))
+			for read, cigar, reference_id in zip(batch, cigars, reference_ids) :
+				if not cigar : # Mapped without an alignment, nothing to line up
+					ref_windows.append(None)
+					continue
+				contig, contig_seq = contigs[reference_id]
+				if contig_seq is None :
+					ref_windows.append(self.reference.fetch(contig, read.reference_start, read.reference_end))
 				else :
-					if strandness == "D" :
-						modified_sequence = ''.join(['N' if (ref == 'C' and read == 'T') or (ref == 'G' and read == 'A') else read for ref, read in zip(reference_seq, read_sequence)])
-					else :
-						modified_sequence = ''.join(['N' if ref == 'G' and read == 'A' else read for ref, read in zip(reference_seq, read_sequence)])
-					calc_GA = modified_sequence.count('N') # Calculate number of A<G transversions in read for scoring
-					nuc_rev_dmg[str(calc_GA)] = nuc_rev_dmg.get(str(calc_GA), 0) + 1
-					calc_MM = ''.join(['Z' if ref != read and not read in ['N','-'] else read for ref, read in zip(reference_seq, read_sequence)]).count('Z')
-					nuc_rev_mm[str(calc_MM)] = nuc_rev_mm.get(str(calc_MM), 0) + 1
-					num_total = modified_sequence.count('N') + calc_indel + calc_MM
-					nuc_rev_tot[str(num_total)] = nuc_rev_tot.get(str(num_total), 0) + 1
-
-				# Reference guided Edge Masking
-				if masking == "E" :
-					if edge_count >= math.floor(len(read_sequence)/2):
-						mask_numb = math.floor(len(read_sequence)/2)-1
-					else:
-						mask_numb = edge_count
-
-					if not read.is_reverse :
-						modified_sequence_L = ''.join(['N' if ref == 'C' and read == 'T' else read for ref, read in zip(reference_seq, read_sequence)])
-						if strandness == "D" :
-							modified_sequence_R = ''.join(['N' if ref == 'G' and read == 'A' else read for ref, read in zip(reference_seq, read_sequence)])
-							modified_sequence = modified_sequence_L[:mask_numb] + read_sequence[mask_numb:len(read_sequence)-mask_numb] + modified_sequence_R[len(read_sequence)-mask_numb:]
-						else:
-							modified_sequence = modified_sequence_L[:mask_numb] + read_sequence[mask_numb:]
-					else:
-						modified_sequence_R = ''.join(['N' if ref == 'G' and read == 'A' else read for ref, read in zip(reference_seq, read_sequence)])
-						if strandness == "D" :
-							modified_sequence_L = ''.join(['N' if ref == 'C' and read == 'T' else read for ref, read in zip(reference_seq, read_sequence)])
-							modified_sequence = modified_sequence_L[:mask_numb] + read_sequence[mask_numb:len(read_sequence)-mask_numb] + modified_sequence_R[len(read_sequence)-mask_numb:]
-						else:
-							modified_sequence = read_sequence[:len(read_sequence)-mask_numb] + modified_sequence_R[len(read_sequence)-mask_numb:]
-
-				# Remove the gap spacers before saving the read back to the newly made SAM/BAM file
-				modified_sequence = modified_sequence.replace('-', '')
-
-			# Hard Masking
-			elif masking == "H" :
-				# Forward read
-				if not read.is_reverse :
-					if strandness == "D":
-						modified_sequence = ''.join(['N' if read == 'A' or read == 'T' else read for read in read_sequence])
-					else :
-						modified_sequence = ''.join(['N' if read == 'T' else read for read in read_sequence])
-				# Reverse read
-				else:
-					if strandness == "D":
-						modified_sequence = ''.join(['N' if read == 'A' or read == 'T' else read for read in read_sequence])
-					else :
-						modified_sequence = ''.join(['N' if read == 'A' else read for read in read_sequence])
-						
-
-			# Edge Masking
-			elif masking == "E" :
-				if edge_count >= math.floor(len(read_sequence)/2) :
-					mask_numb = math.floor(len(read_sequence)/2)-1
-				else:
-					mask_numb = edge_count
-				# Forward read
-				if not read.is_reverse :
-					modified_seq_L = ''.join(['N' if read == 'T' else read for read in read_sequence[:mask_numb]])
-					if strandness == "D" :
-						modified_seq_R = ''.join(['N' if read == 'A' else read for read in read_sequence[len(read_sequence)-mask_numb:]])
-						modified_sequence = modified_seq_L + read_sequence[mask_numb:(len(read_sequence)-mask_numb)] + modified_seq_R
-					else: 
-						modified_sequence = modified_seq_L + read_sequence[mask_numb:]
-				# Reverse read
-				else:
-					modified_seq_R = ''.join(['N' if read == 'A' else read for read in read_sequence[len(read_sequence)-mask_numb:]])
-					if strandness == "D" :
-						modified_seq_L = ''.join(['N' if read == 'T' else read for read in read_sequence[:mask_numb]])
-						modified_sequence = modified_seq_L + read_sequence[mask_numb:(len(read_sequence)-mask_numb)] + modified_seq_R
-					else :
-						modified_sequence = read_sequence[:len(read_sequence)-mask_numb] + modified_seq_R
+					ref_windows.append(contig_seq[read.reference_start:read.reference_end])
+		except KeyError:
+			raise DamageMaskerError(f"It appears either the Reference file {self.ref_file} is not formatted as a FASTA file, or the header does not match that of the supplied SAM/BAM file.\n"
+				"Please make sure the reference file is the same as the one used in your mapping strategy that produced the SAM/BAM file.")
+		stage_start = metrics.add_stage_time('reference', stage_start)
+		# Line the reference sequences up with the reads
+		ref_buf, calc_indel, misaligned = align_batch_to_reference(packed, cigars, ref_windows)
+		if len(misaligned) : # The read runs past the end of the reference contig
+			read = batch[misaligned[0]]
+			raise DamageMaskerError(f"Read {read.query_name} maps beyond the end of {read.reference_name} in the reference file {self.ref_file}.\n"
+				"Please make sure the reference file is the same as the one used in your mapping strategy that produced the SAM/BAM file.")
+		metrics.add_stage_time('cigar', stage_start)
+		return ref_buf, ref_windows, calc_indel
+
+	# Calibrate the edge masking depth on a sample of reads (see calibrate_edge_count). The damage profile of the reads that pass the filters
+	# is measured against the reference without masking or changing them, and the depth per strand and end replaces edge_count,
+	# also for the worker processes. Returns the number of reads used and the frequencies of calibrate_edge_count
+	def calibrate_edge_count(self, reads, threshold=0.01) :
+		if self.ref_file == "NA" or not self.masking == "E" :
+			raise DamageMaskerError("Calibrating the edge masking depth (--auto_edge) requires edge masking (-m E) and reference guidance (--ref_file).")
+		if self.group_maskers :
+			raise DamageMaskerError("Calibrating the edge masking depth (--auto_edge) can't be combined with read group profiles (--rg_config), please set the edge count per read group instead.")
+		stage_start = time.perf_counter()
+		if self.reference is None :
+			self.open_reference()
+		stats = DamageStats(self.stats.profile_length)
+		reads = [read for read in reads if not read.is_unmapped and read.mapping_quality >= self.mapq_cutoff and read.query_length >= self.len_cutoff]
+		for batch_start in range(0, len(reads), BATCH_SIZE) :
+			batch = reads[batch_start:batch_start+BATCH_SIZE]
+			read_seqs = [read.query_sequence for read in batch]
+			is_reverse = np.fromiter((read.is_reverse for read in batch), dtype=bool, count=len(batch))
+			packed = PackedBatch(read_seqs, is_reverse)
+			packed.ref_buf = self.reference_batch(batch, packed, RunMetrics())[0]
+			stats.add_profile(packed)
+		self.edge_count, frequencies = calibrate_edge_count(stats, self.edge_count, threshold)
+		self.settings['edge_count'] = self.edge_count
+		self.metrics.add_stage_time('calibration', stage_start)
+		return len(reads), frequencies
+
+	# Split a batch of reads that passed the filters by read group, and mask every part with the masker of its profile.
+	# The damage statistics and metrics of every part are added to those of the whole run, and to those of its read group
+	def mask_read_groups(self, batch) :
+		parts = {}
+		for read in batch :
+			parts.setdefault(read.get_tag('RG') if read.has_tag('RG') else None, []).append(read)
+		if self.reference is None :
+			self.open_reference()
+		for read_group, part in parts.items() :
+			profile, group = self.group_dispatch.get(read_group, (None, self.default_group))
+			group.reference = self.reference
+			group.stats = DamageStats(self.stats.profile_length)
+			group.metrics = RunMetrics()
+			group.mask_filtered(part)
+			self.stats.merge(group.stats)
+			self.metrics.merge(group.metrics)
+			group.stats.total = len(part)
+			if not read_group in self.read_group_stats :
+				self.read_group_stats[read_group] = [profile, DamageStats(self.stats.profile_length), RunMetrics()]
+			self.read_group_stats[read_group][1].merge(group.stats)
+			self.read_group_stats[read_group][2].merge(group.metrics)
 
-			elif masking == "F" : # If masking is F it won't need to do anything, filtering already happend upstream of the function
-				modified_sequence=read.query_sequence
+	# Add the read group statistics of another masker (e.g. from a worker process) to those of this one
+	def merge_read_group_stats(self, read_group_stats) :
+		for read_group, (profile, stats, metrics) in read_group_stats.items() :
+			if not read_group in self.read_group_stats :
+				self.read_group_stats[read_group] = [profile, DamageStats(stats.profile_length), RunMetrics()]
+			self.read_group_stats[read_group][1].merge(stats)
+			self.read_group_stats[read_group][2].merge(metrics)
 
-			else:
-				print(f"\nError: The masking setting '{masking}' is not recognized. Please use \'S\' for SoftMasking, \'H\' for HardMasking, and \'E\' for EdgeMasking.\n\n")
-				sys.exit(1)
+	# Output the statistics per read group, the profile and masking settings it was masked with, the number of reads and
+	# masked reads and bases, and with reference guidance the C>T frequency of the first and G>A frequency of the last base
+	def write_read_group_tsv(self, file_name) :
+		read_groups = [read_group for read_group in self.read_group_libraries if read_group in self.read_group_stats]
+		read_groups += sorted([read_group for read_group in self.read_group_stats if not read_group in self.read_group_libraries], key=str)
+		with open(file_name, "w") as o:
+			print("read_group\tlibrary\tprofile\tmasking\tedge_count\tstrandness\treads\treads_masked\tbases_masked\tC>T_5'_first_base\tG>A_3'_last_base", file=o)
+			for read_group in read_groups :
+				profile, stats, metrics = self.read_group_stats[read_group]
+				settings = self.group_maskers[profile].settings if profile is not None else self.settings
+				row = ['*' if read_group is None else read_group, self.read_group_libraries.get(read_group) or 'NA', '.' if profile is None else profile,
+					settings['masking'], settings['edge_count'], settings['strandness'], stats.total, metrics.counts['masked'], sum(metrics.bases_masked.values())]
+				if stats.profile.sum() :
+					row += [f"{frequency:.6f}" for frequency in stats.terminal_damage()]
+				else :
+					row += ['NA', 'NA']
+				print('\t'.join(str(field) for field in row), file=o)
+
+	# Mask a stream of reads and write the reads that passed the filters to an open output file, keeping track of the time spent per stage.
+	# Filtered out reads are passed through unmasked with keep_filtered or filtered_file (see read_batches).
+	# With a Checkpoint, the output goes to its chunks, and a checkpoint is saved between batches whenever one is due
+	def write_masked_reads(self, reads, out_file, checkpoint=None, keep_filtered=False, filtered_file=None) :
+		metrics = self.metrics
+		loop_start = time.perf_counter()
+		busy_time = 0.0
+		for batch, passed in self.read_batches(reads, keep_filtered, filtered_file) :
+			busy_time += self.write_batch(batch, out_file, passed)
+			metrics.report_progress()
+			if checkpoint is not None and checkpoint.due() :
+				stage_start = time.perf_counter()
+				out_file = checkpoint.save()
+				busy_time += metrics.add_stage_time('writing', stage_start) - stage_start
+		# Everything outside of the masking and writing of batches is spent reading (decompressing, decoding and filtering) the reads
+		metrics.stage_time['decoding'] += time.perf_counter() - loop_start - busy_time
 
-			read.query_sequence = modified_sequence  # Update the sequence field
-#			read.query_qualities = modified_qualities # Preserve the original quality values
+	# Pipelined version of write_masked_reads, a reader thread decodes and filters the reads into batches, the calling thread masks
+	# the batches and a writer thread encodes and writes them. The stages are connected by queues of at most queue_size batches,
+	# a stage that runs ahead simply waits until the next stage catches up, so memory stays bounded. Batches go through the queues
+	# first in first out, so the reads keep their order. pysam releases the GIL while htslib reads, (de)compresses and writes,
+	# so the decoding and encoding run alongside the masking
+	def write_masked_reads_pipelined(self, reads, out_file, queue_size=4, keep_filtered=False, filtered_file=None) :
+		metrics = self.metrics
+		read_queue = queue.Queue(queue_size)
+		write_queue = queue.Queue(queue_size)
+		stop = threading.Event() # Set when any of the stages fails, so the others stop as well
+		errors = []
 
+		# Hand a batch to the next stage, returns the time spent waiting for room in the queue
+		def put(batch_queue, batch) :
+			wait_start = time.perf_counter()
+			while not stop.is_set() :
+				try:
+					batch_queue.put(batch, timeout=0.1)
+					break
+				except queue.Full :
+					pass
+			return time.perf_counter() - wait_start
+
+		# Take the next batch from the previous stage, None once it's done (or failed)
+		def get(batch_queue) :
+			while True :
+				try:
+					return batch_queue.get(timeout=0.1)
+				except queue.Empty :
+					if stop.is_set() :
+						return None
+
+		def reader() :
+			loop_start = time.perf_counter()
+			wait_time = 0.0
+			try:
+				for batches in self.read_batches(reads, keep_filtered, filtered_file) :
+					wait_time += put(read_queue, batches)
+					if stop.is_set() :
+						return
+			except BaseException as error :
+				errors.append(error)
+				stop.set()
+			finally:
+				put(read_queue, None)
+				metrics.stage_time['decoding'] += time.perf_counter() - loop_start - wait_time
+
+		def writer() :
+			try:
+				while True :
+					batch = get(write_queue)
+					if batch is None :
+						break
+					stage_start = time.perf_counter()
+					for read in batch :
+						out_file.write(read)
+					metrics.counts['written'] += len(batch)
+					metrics.add_stage_time('writing', stage_start)
+			except BaseException as error :
+				errors.append(error)
+				stop.set()
+
+		threads = [threading.Thread(target=reader, daemon=True), threading.Thread(target=writer, daemon=True)]
+		for thread in threads :
+			thread.start()
+		try:
+			while True :
+				batches = get(read_queue)
+				if batches is None :
+					break
+				batch, passed = batches
+				if passed :
+					self.mask_filtered(passed)
+				put(write_queue, batch)
+				metrics.report_progress()
+		except BaseException as error :
+			errors.append(error)
+			stop.set()
+		finally:
+			put(write_queue, None)
+			for thread in threads :
+				thread.join()
+		if errors :
+			raise errors[0]
+
+	# Mask the reads of a batch that passed the filters (all of them, unless given) and write the whole batch, returns the time this took
+	def write_batch(self, batch, out_file, passed=None) :
+		batch_start = time.perf_counter()
+		if passed is None :
+			passed = batch
+		if passed :
+			self.mask_filtered(passed)
+		stage_start = time.perf_counter()
+		for read in batch :
 			out_file.write(read)
+		self.metrics.counts['written'] += len(batch)
+		return self.metrics.add_stage_time('writing', stage_start) - batch_start
+
+	# Mask a SAM/BAM/CRAM file, SAM/BAM/CRAM are recognized from the file content, so '-' can be used to read from stdin (and write to stdout).
+	# With more than one thread an indexed BAM file is masked by a pool of worker processes. regions limits the masking to a list of regions,
+	# either samtools style region strings or 0-based (contig, start, end) tuples, read through the index of the BAM/CRAM file.
+	# Overlapping regions are merged, and reads overlapping several regions are only written once.
+	# pipeline runs the reading, masking and writing in separate threads (see write_masked_reads_pipelined).
+	# write_index indexes the output (BAM/CRAM) of coordinate sorted input, while writing where possible (see BamIndexWriter).
+	# auto_edge calibrates the edge masking depth on a sample of this many reads first (see calibrate_edge_count), spread over the file
+	# through its index, or taken from the start of the file when it has no index.
+	# checkpoint saves a checkpoint every this many seconds, and resume continues from the last checkpoint of an earlier run (see Checkpoint)
+	# The reads that don't pass the filters (unmapped, below the MapQ or length cutoff) are dropped, unless keep_filtered keeps them
+	# (unmasked) in the output, or filtered_output writes them to a file of their own, in the same format as the output
+	def mask_file(self, input_file, output_file, *, output_format='bam', threads=1, chunk_size=10000000, compression_level=None, io_threads=1, regions=None, pipeline=False, write_index=False, auto_edge=0, auto_edge_threshold=0.01, checkpoint=0, resume=False, keep_filtered=False, filtered_output=None) :
+		if not input_file == '-' and not os.path.exists(input_file) :
+			raise DamageMaskerError(f"Input SAM/BAM/CRAM file '{input_file}' not found.")
+		if not output_format in output_modes :
+			raise DamageMaskerError(f"The output format '{output_format}' is not recognized, use one of: {', '.join(output_modes)}.")
+		if threads < 1 or chunk_size < 1 or io_threads < 1 :
+			raise DamageMaskerError("--threads, --chunk_size and --io_threads need to be at least 1.")
+		if auto_edge < 0 or not 0 < auto_edge_threshold < 1 :
+			raise DamageMaskerError("--auto_edge_reads needs to be at least 1, and --auto_edge_threshold a frequency between 0 and 1.")
+		if write_index and (output_file == '-' or output_format == 'sam') :
+			raise DamageMaskerError("Only BAM and CRAM output written to a file can be indexed, --write_index can't be used with SAM output or stdout.")
+		if checkpoint < 0 :
+			raise DamageMaskerError("--checkpoint needs to be a positive number of seconds.")
+		if resume and not checkpoint :
+			raise DamageMaskerError("--resume continues from the checkpoints of --checkpoint, please give the checkpoint interval as well.")
+		if checkpoint and (input_file == '-' or output_file == '-' or not output_format in ['bam', 'ubam'] or threads > 1 or regions is not None or pipeline) :
+			raise DamageMaskerError("Checkpoints can only be made of a single core run (no --threads, --region or --pipeline) that reads a BAM file and writes BAM output to a file.")
+		if keep_filtered and filtered_output is not None :
+			raise DamageMaskerError("The filtered out reads are either kept in the output (--keep_filtered) or written to a file of their own (--filtered_output), not both.")
+		if filtered_output is not None and (filtered_output == output_file or checkpoint) :
+			raise DamageMaskerError("--filtered_output needs a file of its own, other than the output file, and can't be combined with --checkpoint.")
+
+		if output_format == 'cram' and self.ref_file == "NA" :
+			print(f"Warning: No reference was given for the CRAM output, htslib looks it up through the header or embeds it in the CRAM file (which makes it a lot bigger). Give the reference with --ref_file to avoid that.", file=sys.stderr)
+		with open_input(input_file, self.ref_file, io_threads) as in_file :
+			reads = in_file
+			sorted_input = in_file.header.to_dict().get('HD', {}).get('SO') == 'coordinate'
+			lengths = in_file.lengths
+			if write_index and not sorted_input :
+				raise DamageMaskerError(f"The output can only be indexed when {input_file} is coordinate sorted (SO:coordinate in the header). Please sort it first (samtools sort), or leave out --write_index.")
+			unmatched = self.set_read_groups(in_file.header)
+			if unmatched :
+				print(f"Warning: The read group profiles {', '.join(unmatched)} don't match the ID or LB of any @RG line of {input_file}, they are only used for reads with that RG tag.", file=sys.stderr)
+			if checkpoint :
+				if not in_file.is_bam :
+					raise DamageMaskerError(f"Checkpoints can only be made while reading a BAM file, {input_file} is not one.")
+				checkpoint = Checkpoint(self, in_file, input_file, output_file, output_format, compression_level, io_threads, checkpoint)
+				checkpoint.load(resume)
+				if checkpoint.resumed : # The calibrated edge count came with the checkpoint
+					auto_edge = 0
+			if regions is not None :
+				if input_file == '-' or in_file.is_sam or not in_file.has_index() :
+					raise DamageMaskerError(f"Masking a subset of regions requires an indexed BAM or CRAM file, please index {input_file} first (samtools index {input_file}).")
+				regions = merge_regions(in_file, [parse_region(region, in_file) if isinstance(region, str) else region for region in regions])
+				reads = chunk_reads(in_file, [piece for chunk in genome_chunker(in_file, chunk_size, regions) for piece in chunk])
+			if auto_edge :
+				self.open_reference(sorted_input)
+				if input_file == '-' : # The sampled reads are masked with the rest of the stream afterwards
+					reads = iter(reads)
+					sample = list(itertools.islice(reads, auto_edge))
+					reads = itertools.chain(sample, reads)
+				else :
+					with open_input(input_file, self.ref_file) as sample_file :
+						if sample_file.is_sam or not sample_file.has_index() :
+							sample = list(itertools.islice(sample_file, auto_edge))
+						else :
+							sample = sample_reads(sample_file, auto_edge, regions)
+				sampled, frequencies = self.calibrate_edge_count(sample, auto_edge_threshold)
+				print(f"Calibrated the edge masking depth on {sampled:,} sampled reads: {edge_count_name(self.edge_count, self.strandness)}", file=sys.stderr)
+				for strand_name, strand_frequencies in zip(DamageStats.strand_names, frequencies) :
+					for end_name, damage_name, end_frequencies in list(zip(DamageStats.end_names, ['C>T', 'G>A'], strand_frequencies))[:1 if self.strandness == "S" else 2] :
+						if end_frequencies is None :
+							print(f"Warning: Too few {strand_name} reads were sampled to calibrate the {end_name} end, it keeps the edge count it was given.", file=sys.stderr)
+						else :
+							print(f"  {strand_name} {end_name} {damage_name}: {end_frequencies[0]:.4f} on the first base, {end_frequencies[1]:.4f} background", file=sys.stderr)
+			if threads > 1 :
+				if input_file == '-' or in_file.is_sam :
+					print(f"Warning: Multi-process masking requires an indexed BAM or CRAM file, {input_file} will be processed on a single core.", file=sys.stderr)
+				elif not output_format in ['bam', 'ubam', 'cram'] :
+					print(f"Warning: Multi-process masking can only write BAM or CRAM output, {input_file} will be processed on a single core.", file=sys.stderr)
+				elif not in_file.has_index() :
+					print(f"Warning: No index (.bai/.csi/.crai) was found for {input_file}, it will be processed on a single core. Run 'samtools index {input_file}' to enable multi-process masking.", file=sys.stderr)
+				else :
+					in_file.close()
+					self.mask_file_parallel(input_file, output_file, threads, chunk_size, output_format, compression_level, regions, keep_filtered, filtered_output)
+					if write_index :
+						stage_start = time.perf_counter()
+						index_output(output_file, lengths, io_threads)
+						self.metrics.add_stage_time('writing', stage_start)
+					return
+			self.open_reference(sorted_input)
+			if checkpoint :
+				self.write_masked_reads(reads, checkpoint.open_chunk(), checkpoint, keep_filtered)
+				stage_start = time.perf_counter()
+				checkpoint.finish()
+				if write_index :
+					index_output(output_file, lengths, io_threads)
+				self.metrics.add_stage_time('writing', stage_start)
+				return
+			index_writer = None
+			with open_output(output_file, output_format, in_file.header, self.ref_file, compression_level, io_threads) as out_file, open_filtered_output(filtered_output, output_format, in_file.header, self.ref_file, compression_level, io_threads) as filtered_file :
+				if write_index and output_format in ['bam', 'ubam'] and io_threads == 1 and max(lengths, default=0) < 2**29 :
+					out_file = index_writer = BamIndexWriter(out_file, output_file + ".bai")
+				if pipeline :
+					self.write_masked_reads_pipelined(reads, out_file, keep_filtered=keep_filtered, filtered_file=filtered_file)
+				else :
+					self.write_masked_reads(reads, out_file, keep_filtered=keep_filtered, filtered_file=filtered_file)
+			# The index is written after the output file is closed, so it is never older than the file it indexes
+			stage_start = time.perf_counter()
+			if index_writer is not None :
+				index_writer.close()
+			elif write_index :
+				index_output(output_file, lengths, io_threads)
+			self.metrics.add_stage_time('writing', stage_start)
+
+	# Mask an indexed BAM or CRAM file using a pool of worker processes, one genome chunk at a time.
+	# The chunks are processed out of order, but are collected and concatenated in genome order afterwards,
+	# so the output has exactly the same read order as a single core run. Unmapped reads without a position are
+	# never returned by region queries, when the filtered out reads are kept (or written to filtered_output) they get
+	# a chunk of their own at the end, where they are in a sorted file as well
+	def mask_file_parallel(self, input_file, output_file, threads, chunk_size, output_format='bam', compression_level=None, regions=None, keep_filtered=False, filtered_output=None) :
+		with open_input(input_file, self.ref_file) as bam :
+			chunks = genome_chunker(bam, chunk_size, regions)
+			if (keep_filtered or filtered_output is not None) and regions is None :
+				chunks.append([('*', None, None, -1)])
+			if not chunks : # Nothing to mask, just write out the header
+				with open_output(output_file, output_format, bam.header, self.ref_file, compression_level) :
+					pass
+				return
+
+		# Chunks are written next to the output file, or in the working directory when writing to stdout
+		tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(output_file) + '.', dir=os.path.dirname(os.path.abspath(output_file)) if not output_file == '-' else None)
+		try:
+			tasks = []
+			for i, pieces in enumerate(chunks) :
+				chunk_file = os.path.join(tmp_dir, f"chunk_{i:06d}{output_extentions[output_format]}")
+				filtered_chunk_file = None if filtered_output is None else os.path.join(tmp_dir, f"filtered_{i:06d}{output_extentions[output_format]}")
+				tasks.append((input_file, pieces, chunk_file, filtered_chunk_file, output_format, compression_level, keep_filtered))
+			with multiprocessing.Pool(min(threads, len(tasks)), initializer=parallel_worker_init, initargs=(self.settings,)) as pool :
+				for chunk_stats, chunk_metrics, chunk_read_group_stats in pool.imap_unordered(parallel_worker, tasks) :
+					self.stats.merge(chunk_stats)
+					self.metrics.merge(chunk_metrics)
+					self.merge_read_group_stats(chunk_read_group_stats)
+					self.metrics.report_progress()
+			stage_start = time.perf_counter()
+			cat_chunks(output_file, [task[2] for task in tasks], tmp_dir)
+			if filtered_output is not None :
+				cat_chunks(filtered_output, [task[3] for task in tasks], tmp_dir)
+			self.metrics.add_stage_time('writing', stage_start)
+		finally:
+			shutil.rmtree(tmp_dir, ignore_errors=True)
+
+	# Output the additional stats files of reference guided masking, the "edit distance" tsv, the positional damage profile and both combined as json,
+	# and the statistics per read group when masking with read group profiles
+	def write_stats(self, file_base, input_file) :
+		if not self.ref_file == "NA" :
+			self.stats.write_tsv(file_base+"_stats.tsv", input_file)
+			self.stats.write_profile_tsv(file_base+"_damage_profile.tsv")
+			self.stats.write_json(file_base+"_stats.json", input_file)
+		if self.group_maskers :
+			self.write_read_group_tsv(file_base+"_read_groups.tsv")
+
+# Work out the output format and output file name of an input file. Unless the output format is given, the same format as the input
+# is written (or BAM, when it's streamed in through stdin), and the matching extention is added to the output file when it's missing
+def output_settings(input_file, output_file, output_format=None) :
+	if output_format is None :
+		extention_test = input_file.lower() if not input_file == '-' else output_file.lower()
+		if '.cram' in extention_test :
+			output_format = 'cram'
+		elif '.sam' in extention_test :
+			output_format = 'sam'
+		elif '.bam' in extention_test or input_file == '-' :
+			output_format = 'bam'
+		else :
+			raise DamageMaskerError(f"It could not be determined if '{input_file}' is a SAM, BAM or CRAM formatted file. Make sure the file has a .sam, .bam or .cram extention, or set the output format with --output_format.")
+	extention = output_extentions[output_format]
+	if not output_file == '-' and not output_file.endswith(extention) :
+		output_file += extention
+	return output_file, output_format
+
+# Read a tab separated file of --input_list or --rg_config, lines starting with '#' are skipped, so the file can have a header.
+# Yields the line number, the first key_count columns, and the masking, edge count and strandness given in the columns after
+# those (left out, empty or '.' means the command line setting is used, so it isn't part of the overrides)
+def read_settings_file(file_name, key_count) :
+	with open(file_name) as f :
+		for line_number, line in enumerate(f, 1) :
+			if line.startswith('#') or not line.strip() :
+				continue
+			fields = [field.strip() for field in line.rstrip('\n').split('\t')] + [''] * (key_count + 3)
+			overrides = {name: column for column, name in zip(fields[key_count:key_count+3], ['masking', 'edge_count', 'strandness']) if column and not column == '.'}
+			if 'edge_count' in overrides :
+				try:
+					overrides['edge_count'] = int(overrides['edge_count'])
+				except ValueError :
+					raise DamageMaskerError(f"The edge count '{overrides['edge_count']}' on line {line_number} of {file_name} is not a number.")
+			yield line_number, fields[:key_count], overrides
+
+# Read the sample list of --input_list, a tab separated file with an input and output file per line, optionally followed by
+# the masking, edge count and strandness of that sample (see read_settings_file)
+def read_input_list(input_list) :
+	if not os.path.exists(input_list) :
+		raise DamageMaskerError(f"Input list '{input_list}' not found.")
+	samples = []
+	for line_number, (input_file, output_file), overrides in read_settings_file(input_list, 2) :
+		if not input_file or not output_file :
+			raise DamageMaskerError(f"Line {line_number} of {input_list} needs at least an input and an output file, separated by a tab.")
+		samples.append(dict({'input_file': input_file, 'output_file': output_file}, **overrides))
+	return samples
+
+# Read the read group profiles of --rg_config, a tab separated file with a read group ID or library (LB) per line, followed by
+# the masking, edge count and strandness for the reads of that read group (see read_settings_file)
+def read_rg_config(rg_config) :
+	if not os.path.exists(rg_config) :
+		raise DamageMaskerError(f"Read group config '{rg_config}' not found.")
+	read_groups = OrderedDict()
+	for line_number, (read_group,), overrides in read_settings_file(rg_config, 1) :
+		if not read_group :
+			raise DamageMaskerError(f"Line {line_number} of {rg_config} needs a read group ID or library as its first column.")
+		if read_group in read_groups :
+			raise DamageMaskerError(f"The read group '{read_group}' is listed twice in {rg_config} (line {line_number}).")
+		read_groups[read_group] = overrides
+	return read_groups
+
+# Every batch worker process opens the reference once, and shares it between all samples it masks
+batch_reference = None
+
+def batch_worker_init(ref_file, ref_cache_mb) :
+	global batch_reference
+	if not ref_file == "NA" :
+		batch_reference = open_reference_file(ref_file, False, ref_cache_mb) # Every sample sets the access mode of its own sort order
+
+# Mask a single sample of a batch and write its stats files, returns the sample with its stats and metrics, or the error that stopped it
+def batch_worker(task) :
+	sample_index, sample, settings, file_settings = task
+	try:
+		sample_settings = dict(settings)
+		sample_settings.update({name: sample[name] for name in ['masking', 'edge_count', 'strandness'] if name in sample})
+		with Masker(**sample_settings, reference=batch_reference) as masker :
+			output_file, output_format = output_settings(sample['input_file'], sample['output_file'], file_settings['output_format'])
+			sample_settings['output_file'] = output_file
+			masker.mask_file(sample['input_file'], output_file, **dict(file_settings, output_format=output_format, auto_edge=file_settings['auto_edge'] if masker.masking == "E" else 0))
+			sample_settings['edge_count'] = masker.settings['edge_count']
+		masker.write_stats(output_file, sample['input_file'])
+	except DamageMaskerError as error :
+		return sample_index, sample_settings, None, None, str(error)
+	return sample_index, sample_settings, masker.stats, masker.metrics, None
+
+# Mask all samples of a sample list, several samples at once when threads is above 1. Every process opens the reference once
+# for all the samples it masks. Returns a list of (settings, stats, metrics, error) per sample, in the order of the sample list
+def mask_batch_files(samples, settings, file_settings, threads=1) :
+	tasks = [(i, sample, settings, file_settings) for i, sample in enumerate(samples)]
+	results = [None] * len(tasks)
+	if threads > 1 and len(tasks) > 1 :
+		with multiprocessing.Pool(min(threads, len(tasks)), initializer=batch_worker_init, initargs=(settings['ref_file'], settings['ref_cache_mb'])) as pool :
+			for sample_index, *result in pool.imap_unordered(batch_worker, tasks) :
+				results[sample_index] = result
+				print(f"Finished {samples[sample_index]['input_file']} ({sum(result is not None for result in results)}/{len(tasks)})", flush=True)
+	else :
+		global batch_reference
+		batch_worker_init(settings['ref_file'], settings['ref_cache_mb'])
+		try:
+			for task in tasks :
+				sample_index, *result = batch_worker(task)
+				results[sample_index] = result
+				print(f"Finished {samples[sample_index]['input_file']} ({sample_index+1}/{len(tasks)})", flush=True)
+		finally:
+			if batch_reference is not None :
+				batch_reference.close()
+				batch_reference = None
+	return results
+
+# Output the summary table of a batch, one row per sample (with its masking settings, read counts and, with reference guidance,
+# the C>T frequency of the first and G>A frequency of the last base of the molecules), plus a row with all samples combined
+def write_batch_summary(file_name, samples, results) :
+	total_stats = None
+	total_metrics = RunMetrics()
+	with open(file_name, "w") as o:
+		print("input_file\toutput_file\tmasking\tedge_count\tstrandness\tstatus\treads_seen\tunmapped\tlow_mapq\ttoo_short\treads_written\treads_masked\tbases_masked\tseconds\tC>T_5'_first_base\tG>A_3'_last_base", file=o)
+		for sample, (settings, stats, metrics, error) in zip(samples, results) :
+			row = [sample['input_file'], settings.get('output_file', sample['output_file']), settings['masking'], edge_count_name(settings['edge_count'], settings['strandness']), settings['strandness']]
+			if error is not None :
+				print('\t'.join(str(field) for field in row + ['failed: ' + error.replace('\n', ' ')] + ['NA'] * 10), file=o)
+				continue
+			total_metrics.merge(metrics)
+			if not settings['ref_file'] == "NA" :
+				if total_stats is None :
+					total_stats = DamageStats(stats.profile_length)
+				total_stats.merge(stats)
+			print('\t'.join(str(field) for field in row + ['ok'] + batch_summary_fields(stats, metrics)), file=o)
+		if total_stats is None :
+			total_stats = DamageStats()
+		print('\t'.join(str(field) for field in ['total', '', '', '', '', ''] + batch_summary_fields(total_stats, total_metrics)), file=o)
+
+def batch_summary_fields(stats, metrics) :
+	counts = metrics.counts
+	fields = [counts[name] for name in ['seen', 'unmapped', 'low_mapq', 'too_short', 'written', 'masked']]
+	fields += [sum(metrics.bases_masked.values()), f"{sum(metrics.stage_time.values()):.2f}"]
+	if stats.total and stats.profile.sum() :
+		fields += [f"{frequency:.6f}" for frequency in stats.terminal_damage()]
+	else :
+		fields += ['NA', 'NA']
+	return fields
+
+# Run a function under cProfile or pyinstrument, the report is written to <file_base>_profile.prof (cProfile, open it with
+# pstats or snakeviz) or <file_base>_profile.html (pyinstrument), and the top of the cProfile report is printed as well
+def profiled_run(profiler, file_base, function, *function_args, **function_kwargs) :
+	if profiler == "cprofile" :
+		import cProfile
+		import pstats
+		profile = cProfile.Profile()
+		profile.runcall(function, *function_args, **function_kwargs)
+		profile.dump_stats(file_base + "_profile.prof")
+		pstats.Stats(profile, stream=sys.stdout).sort_stats('cumulative').print_stats(25)
+		print(f"Profile is stored to: {file_base}_profile.prof")
+	else :
+		try:
+			import pyinstrument
+		except ImportError:
+			raise DamageMaskerError("Profiling with pyinstrument requires pyinstrument to be installed.\nTry \'pip install pyinstrument\' or \'pip3 install pyinstrument\' (depending on your setup) to install it.")
+		profile = pyinstrument.Profiler()
+		profile.start()
+		try:
+			function(*function_args, **function_kwargs)
+		finally:
+			profile.stop()
+		with open(file_base + "_profile.html", "w") as o:
+			o.write(profile.output_html())
+		print(f"Profile is stored to: {file_base}_profile.html")
+
+# The 'index' subcommand, pack a reference FASTA file for reference guided masking (see PackedReference)
+def index_main(argv) :
+	parser = argparse.ArgumentParser(prog='DamageMasker.py index', description='Pack a reference FASTA file once, so reference guided masking runs can memory map it instead of reading the FASTA file every time')
+	parser.add_argument('ref_file', help='Reference FASTA file (plain or bgzip compressed)')
+	parser.add_argument('-o', '--output_file', default=None, metavar='', help='Packed reference file (default: <ref_file>.dmref, where masking runs pick it up automatically)')
+	args = parser.parse_args(argv)
+	if not os.path.exists(args.ref_file) :
+		print(f"\nError: Input reference FASTA file '{args.ref_file}' not found.\n\n")
+		sys.exit(1)
+	packed_file = args.output_file if args.output_file is not None else packed_reference_name(args.ref_file)
+	if not packed_file.endswith(".dmref") :
+		packed_file += ".dmref"
+	try:
+		contig_count, base_count = write_packed_reference(args.ref_file, packed_file)
+	except DamageMaskerError as error :
+		print(f"\nError: {error}\n\n")
+		sys.exit(1)
+	print(f"\nPacked {contig_count} contigs ({base_count:,} bp) of {args.ref_file} into {packed_file}\n")
+
+# The settings of the command line that a Masker takes, as its keyword arguments
+def masker_settings(args, read_groups) :
+	return {'masking':args.masking, 'edge_count':args.edge_count, 'strandness':args.strandness, 'ref_file':args.ref_file, 'mapq_cutoff':args.mapq_cutoff, 'len_cutoff':args.len_cutoff,
+		'soft_mask':args.soft_mask, 'mask_quality':args.mask_quality, 'ref_cache_mb':args.ref_cache_mb, 'profile_length':args.profile_length, 'progress_interval':args.progress,
+		'sites_file':args.sites, 'update_tags':args.calmd, 'strip_tags':args.strip_tags_list, 'read_groups':read_groups}
+
+# The settings of the command line that Masker.mask_file takes, as its keyword arguments
+def mask_file_settings(args, regions) :
+	return {'output_format':args.output_format, 'threads':args.threads, 'chunk_size':args.chunk_size, 'compression_level':args.compression_level, 'io_threads':args.io_threads, 'regions':regions,
+		'pipeline':args.pipeline, 'write_index':args.write_index, 'auto_edge':args.auto_edge_reads if args.auto_edge else 0, 'auto_edge_threshold':args.auto_edge_threshold,
+		'checkpoint':args.checkpoint, 'resume':args.resume, 'keep_filtered':args.keep_filtered, 'filtered_output':args.filtered_output}
+
+# Batch mode (--input_list), mask every sample of the list with the command line settings (unless the list says otherwise per sample),
+# using --threads processes that each mask one sample at a time. Writes the stats files per sample, and a summary table of all samples
+def batch_main(args) :
+	try:
+		samples = read_input_list(args.input_list)
+		if any(sample['output_file'] == '-' or sample['input_file'] == '-' for sample in samples) :
+			raise DamageMaskerError("Samples in an input list can't be streamed through stdin or stdout, please give file names.")
+		if args.filtered_output is not None :
+			raise DamageMaskerError("--filtered_output names a single file, it can't be used with an input list. Use --keep_filtered to keep the filtered out reads in the output of every sample.")
+		regions = None
+		if args.region is not None or args.regions_file is not None :
+			regions = (args.region or []) + (read_regions_file(args.regions_file) if args.regions_file is not None else [])
+		read_groups = read_rg_config(args.rg_config) if args.rg_config is not None else None
+		settings = dict(masker_settings(args, read_groups), progress_interval=0) # Several samples are masked at once, so there is no progress per sample
+		# Check the settings up front, before any sample is started
+		Masker(**settings).close()
+	except DamageMaskerError as error :
+		print(f"\nError: {error}\n\n")
+		sys.exit(1)
+	if args.threads < 1 or args.chunk_size < 1 or args.io_threads < 1 :
+		print(f"\nError: --threads, --chunk_size and --io_threads need to be at least 1.\n\n")
+		sys.exit(1)
+	summary_file = os.path.splitext(args.input_list)[0] + "_summary.tsv"
+	print(f"\nDamageMasker will now process the {len(samples)} samples in {args.input_list}, {min(args.threads, len(samples))} at a time")
+	if not args.ref_file == "NA" :
+		print(f"Reference used: {args.ref_file}")
+	print(f"Summary of all samples will be saved to: {summary_file}\n")
+
+	file_settings = dict(mask_file_settings(args, regions), threads=1) # The threads mask several samples at once, every sample gets a single core
+	results = mask_batch_files(samples, settings, file_settings, args.threads)
+	write_batch_summary(summary_file, samples, results)
+	if args.metrics_json is not None :
+		with open(args.metrics_json, "w") as o:
+			json.dump([dict(input_file=sample['input_file'], **metrics.summary()) for sample, (settings, stats, metrics, error) in zip(samples, results) if error is None], o, indent=1)
+
+	failed = [(sample, result[3]) for sample, result in zip(samples, results) if result[3] is not None]
+	print(f"\nFinished processing {len(samples) - len(failed)} of {len(samples)} samples, {sum(result[1].total for result in results if result[3] is None)} reads processed\n")
+	for sample, error in failed :
+		print(f"Error: {sample['input_file']} failed: {error}")
+	if failed :
+		print()
+		sys.exit(1)
+	print()
 
 def main() :
+	if len(sys.argv) > 1 and sys.argv[1] == 'index' :
+		index_main(sys.argv[2:])
+		return
 	parser = argparse.ArgumentParser(description='Mask a SAM/BAM file for deaminated bases based on reference genome. The script can softmask, hardmask and edgemask', add_help=False)
-	parser.add_argument('-m', '--masking', default="H", metavar='', help='Change masking behaviour.\n\'H\' for HardMasking.\n\'E\' for EdgeMasking.\n\'F\' for Filtering. (default: Hardmasking)\n')
-	parser.add_argument('-i', '--input_file', default="NA", metavar='', help='Input BAM or SAM file (mandatory)')
+	parser.add_argument('-m', '--masking', default="H", metavar='', help='Change masking behaviour.\n\'H\' for HardMasking.\n\'E\' for EdgeMasking.\n\'S\' for SoftMasking (HardMasking through base qualities).\n\'F\' for Filtering. (default: Hardmasking)\n')
+	parser.add_argument('--soft_mask', action='store_true', help='Mask damage by setting the base quality to --mask_quality instead of replacing the base with an N, can be combined with HardMasking and EdgeMasking')
+	parser.add_argument('--mask_quality', type=int, default=0, metavar='', help='Base quality given to masked bases when soft masking (default: 0)')
+	parser.add_argument('-i', '--input_file', default="NA", metavar='', help='Input SAM, BAM or CRAM file, use \'-\' to read from stdin, CRAM files are decoded with the reference of --ref_file when given (mandatory)')
+	parser.add_argument('--input_list', default=None, metavar='', help='Tab separated file with an input and output file per line, optionally followed by the masking, edge count and strandness of that sample, to mask a batch of samples in one go (replaces -i and -o)')
 	parser.add_argument('-s', '--strandness', default="S", metavar='', help='Determine strandness of dataset, \'S\' for single stranded libraries, and \'D\' for double stranded libraries (default: S, for sslib)')
 	parser.add_argument('-e', '--edge_count', type=int, default=5, metavar='', help='Number of bases to be masked from 5\' and 3\' edges if --masking \'E\' is turned on (default: 5)')
-	parser.add_argument('-r', '--ref_file', default="NA", metavar='', help='Give the path to a reference genome file if you want to turn on reference guidance (default: turned off)')
+	parser.add_argument('--auto_edge', action='store_true', help='Calibrate the edge count of --masking \'E\' on a sample of reads before masking, per strand and end, from the C>T and G>A frequencies against the reference (requires --ref_file)')
+	parser.add_argument('--auto_edge_reads', type=int, default=100000, metavar='', help='Number of reads sampled to calibrate the edge count with --auto_edge (default: 100000)')
+	parser.add_argument('--auto_edge_threshold', type=float, default=0.01, metavar='', help='Edge masking stops at the first position where the damage frequency is less than this above the background, with --auto_edge (default: 0.01)')
+	parser.add_argument('-r', '--ref_file', default="NA", metavar='', help='Give the path to a reference genome file if you want to turn on reference guidance, a packed reference (.dmref, see \'DamageMasker.py index\') is used when available (default: turned off)')
+	parser.add_argument('--ref_cache_mb', type=int, default=1024, metavar='', help='Memory cap (in MB) for reference contigs kept in memory during reference guidance (default: 1024)')
+	parser.add_argument('--sites', default=None, metavar='', help='BED or VCF file (optionally gzipped) with the sites of a target panel, only bases on these sites are masked and reads without any site are left untouched (default: off)')
+	parser.add_argument('--rg_config', default=None, metavar='', help='Tab separated file with a read group ID or library (LB) per line, followed by the masking, edge count and strandness for the reads of that read group, to mask libraries of different types in one pass (default: off)')
+	parser.add_argument('--region', action='append', default=None, metavar='', help='Only mask the reads of this region (\'chr\', \'chr:start\' or \'chr:start-end\', 1-based), can be given several times, requires an indexed BAM/CRAM file (default: whole file)')
+	parser.add_argument('--regions_file', default=None, metavar='', help='Only mask the reads of the regions in this BED file, requires an indexed BAM/CRAM file (default: whole file)')
+	parser.add_argument('--calmd', action='store_true', help='Recompute the MD and NM tags of the masked reads in the same pass, so no samtools calmd run is needed afterwards (requires --ref_file)')
+	parser.add_argument('--strip_tags', default="", metavar='', help='Comma separated list of tags to remove from every read, e.g. sequence dependent tags like BQ or OQ (default: none)')
+	parser.add_argument('-t', '--threads', '--workers', type=int, default=1, metavar='', help='Number of worker processes used to mask an indexed BAM or CRAM file in parallel (default: 1)')
+	parser.add_argument('--chunk_size', type=int, default=10000000, metavar='', help='Size of the genome chunks (in bp) handed to each worker process when --threads is above 1 (default: 10000000)')
+	parser.add_argument('--profile_length', type=int, default=25, metavar='', help='Number of bases from the 5\' and 3\' ends included in the positional damage profile when using reference guidance (default: 25)')
 	parser.add_argument('-q', '--mapq_cutoff', type=int, default=0, metavar='', help='Remove reads below MAPQ cutoff value from output (default: 0)')
 	parser.add_argument('-l', '--len_cutoff', type=int, default=0, metavar='', help='Remove reads below a certain length from output (default: 0)')
-	parser.add_argument('-o', '--output_file', metavar='', default='output_modified.sam', help='Output SAM/BAM file with modified reads (default: \'output_modified.sam/.bam\')')
+	parser.add_argument('--keep_filtered', action='store_true', help='Keep the reads removed by the filters (unmapped reads, and reads below --mapq_cutoff or --len_cutoff) in the output, unmasked')
+	parser.add_argument('--filtered_output', default=None, metavar='', help='Write the reads removed by the filters (unmapped reads, and reads below --mapq_cutoff or --len_cutoff) unmasked to this file, in the same format as the output (default: off)')
+	parser.add_argument('-o', '--output_file', metavar='', default='output_modified.sam', help='Output SAM/BAM/CRAM file with modified reads, use \'-\' to write to stdout (default: \'output_modified.sam/.bam/.cram\')')
+	parser.add_argument('--output_format', choices=['sam', 'bam', 'ubam', 'cram'], default=None, metavar='', help='Format of the output file, \'sam\', \'bam\', \'ubam\' (uncompressed BAM) or \'cram\' (default: same as the input file)')
+	parser.add_argument('--compression_level', type=int, choices=range(0, 10), default=None, metavar='', help='Compression level (0-9) of BAM/CRAM output (default: htslib default)')
+	parser.add_argument('--pipeline', action='store_true', help='Read, mask and write in three separate threads, so decompression and compression run alongside the masking (single core runs only)')
+	parser.add_argument('--write_index', action='store_true', help='Index the output (.bai, or .csi/.crai) of a coordinate sorted input file, built while writing for BAM output with --io_threads 1')
+	parser.add_argument('--checkpoint', type=float, default=0, metavar='', help='Save a checkpoint every this many seconds, so a run that gets killed can be continued with --resume (single core runs on a BAM file, default: off)')
+	parser.add_argument('--resume', action='store_true', help='Continue from the last checkpoint of an earlier run with the same input, output and settings (with --checkpoint)')
+	parser.add_argument('--io_threads', type=int, default=1, metavar='', help='Number of threads htslib uses for compressing and decompressing the SAM/BAM/CRAM files (default: 1)')
+	parser.add_argument('--progress', type=float, default=0, metavar='', help='Print progress (reads seen, written and masked, and reads per second) every this many seconds, plus a summary of the filtered reads, masked bases and time per stage at the end (default: off)')
+	parser.add_argument('--metrics_json', default=None, metavar='', help='Write the read counts, masked bases per masking mode, throughput and time per stage to this json file (default: off)')
+	parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default=None, metavar='', help='Profile the run with \'cprofile\' or \'pyinstrument\' (main process only), the report is stored next to the output file (default: off)')
 	parser.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='Show this help message and exit.')
 
 	# Check if at least one option is given, if not close the program and prompt the help screen again
@@ -261,55 +2181,59 @@ def main() :
 		sys.exit(1)
 	args = parser.parse_args()
 	
+	if args.progress < 0 :
+		print(f"\nError: --progress needs to be a positive number of seconds.\n\n")
+		sys.exit(1)
+	args.strip_tags_list = [tag.strip() for tag in args.strip_tags.split(',') if tag.strip()]
+
+	if args.input_list is not None :
+		batch_main(args)
+		return
+
 	if args.input_file != "NA":
 		# Check if the input BAM file exists
-		if not os.path.exists(args.input_file) :
-			print(f"\nError: Input SAM/BAM file '{args.input_file}' not found.\n\n")
+		if not args.input_file == '-' and not os.path.exists(args.input_file) :
+			print(f"\nError: Input SAM/BAM/CRAM file '{args.input_file}' not found.\n\n")
 			return
-			# Check if the input BAM file exists
-		extention_test = args.input_file.lower()
-		if '.sam' in extention_test :
-			if not args.output_file.endswith(".sam") :
-				args.output_file += ".sam"
-		elif '.bam' in extention_test :
-			if not args.output_file.endswith(".bam") :
-				args.output_file += ".bam"
-		else :
-			print(f"\nError: It could not be determined if '{input_file}' is a SAM or BAM formatted file. Make sure the file has a .sam or .bam extention.\n\n")
+		try:
+			args.output_file, args.output_format = output_settings(args.input_file, args.output_file, args.output_format)
+		except DamageMaskerError as error :
+			print(f"\nError: {error}\n\n")
 			sys.exit(1)
 	else:
 		print(f"\nError: No input file was given, this is a mandatory argument as the software cannot do anything without an input file.")
 		print(f"Please specify an input SAM or BAM file using the -i or --input_file option, followed by the path to your file.\n\n")
 		sys.exit(1)
 
+	# When the masked reads are streamed to stdout, all messages go to stderr instead
+	if args.output_file == '-' :
+		sys.stdout = sys.stderr
+
 	settings_summary_printer(args)
 
-	args.strandness = args.strandness.upper()
-	if not args.strandness == "D" and not args.strandness == "S" :
-		print(f"\nError: User input for strandness '{args.strandness}' is not recognized.\n")
-		print("\nOnly \'S\'and \'D\' are recognized as valid library types at this point. Please correct, or leave blank to use the default double stranded approach.\n\n")
+	# The command line is a thin wrapper around a Masker, every problem it runs into is reported here
+	try:
+		read_groups = read_rg_config(args.rg_config) if args.rg_config is not None else None
+		with Masker(**masker_settings(args, read_groups)) as masker :
+			regions = None
+			if args.region is not None or args.regions_file is not None :
+				regions = (args.region or []) + (read_regions_file(args.regions_file) if args.regions_file is not None else [])
+			file_settings = mask_file_settings(args, regions)
+			if args.profiler is None :
+				masker.mask_file(args.input_file, args.output_file, **file_settings)
+			else :
+				profiled_run(args.profiler, stats_file_name(args), masker.mask_file, args.input_file, args.output_file, **file_settings)
+	except DamageMaskerError as error :
+		print(f"\nError: {error}\n\n")
 		sys.exit(1)
+	print(f"\nFinished processing {args.input_file}, {masker.stats.total} reads processed\n\n")
 
-	if not args.ref_file =="NA" :
-		if not os.path.exists(args.ref_file) :
-			print(f"\nError: Input reference FASTA file '{args.ref_file}' not found.\n\n")
-			return
-
-	sam_bam_picker(args.input_file, args.ref_file, args.output_file, args.mapq_cutoff, args.len_cutoff, args.masking, args.edge_count, args.strandness)
-	print(f"\nFinished processing {args.input_file}, {nuc_total['Total']} reads processed\n\n")
-
-	if not args.ref_file =="NA" :
-		with open(args.output_file+"_stats.tsv", "a") as o:	# Output an additional stats tsv file containing "edit distance"
-			print(f"Analysis for {args.input_file}, total reads analyzed: {nuc_total['Total']}\n", file=o, end="")
-			print(f"Mismatches\tfwd_reads_dmg\tfwd_reads_indels\tfwd_reads_other_mismatches\tfwd_reads_mismatches_total\t", file=o, end="")
-			print(f"rev_reads_dmg\trev_reads_indels\trev_reads_other_mismatches\trev_reads_mismatches_total\t", file=o, end="")
-			print(f"tot_reads_dmg\ttot_reads_indels\ttot_reads_other_mismatches\ttot_reads_mismatches_total", file=o)
-			for i in range(0,10) :
-				print(f"{i}\t", file=o, end="")
-				print(f"{nuc_fwd_dmg.get(str(i), 0)}\t{nuc_fwd_ins.get(str(i), 0)}\t{nuc_fwd_mm.get(str(i), 0)}\t{nuc_fwd_tot.get(str(i), 0)}\t", file=o, end="")
-				print(f"{nuc_rev_dmg.get(str(i), 0)}\t{nuc_rev_ins.get(str(i), 0)}\t{nuc_rev_mm.get(str(i), 0)}\t{nuc_rev_tot.get(str(i), 0)}\t", file=o, end="")
-				print(f"{(nuc_fwd_dmg.get(str(i), 0)+nuc_rev_dmg.get(str(i), 0))}\t{(nuc_fwd_ins.get(str(i), 0)+nuc_rev_ins.get(str(i), 0))}\t", file=o, end="")
-				print(f"{(nuc_fwd_mm.get(str(i), 0)+nuc_rev_mm.get(str(i), 0))}\t{(nuc_fwd_tot.get(str(i), 0)+nuc_rev_tot.get(str(i), 0))}", file=o)
+	if args.progress :
+		masker.metrics.print_summary()
+		print()
+	if args.metrics_json is not None :
+		masker.metrics.write_json(args.metrics_json, args.input_file)
+	masker.write_stats(stats_file_name(args), args.input_file)
 
 if __name__ == "__main__" :
 	main()